@@ -0,0 +1,291 @@
+"""
+asyncio upload engine (gdrive_upload.py --engine async).
+
+Talks to the Drive v2 REST API directly through one pooled aiohttp session, so hundreds of uploads and metadata
+requests can be in flight on a single thread. Files up to one chunk are sent in a single multipart request,
+bigger files through a resumable session. A multipart request is not repeated blindly: Drive may have created the
+file although the request failed, so the folder is searched first for the file tagged with the request's marker
+(a private property, UPLOAD_MARKER_KEY).
+
+Requires aiohttp (pip install aiohttp), which is imported only when this engine is used.
+"""
+
+import asyncio
+import json
+import mimetypes
+import os
+import uuid
+
+from gdrive_cache import API_ROOT
+from gdrive_query import escape_query_value, files_query, folder_query
+from gdrive_resumable import UPLOAD_URL, DEFAULT_CHUNK_SIZE, parse_range_offset
+from gdrive_retry import RetryPolicy
+
+FILES_URL = API_ROOT + 'drive/v2/files'
+# private property set to a random value by every multipart request, to find the file it created
+UPLOAD_MARKER_KEY = 'gdriveUploadId'
+
+
+class AsyncRequestError(Exception):
+    """ Drive answered with an unexpected status """
+
+    def __init__(self, message, status, content=b'', response=None):
+        super().__init__(message)
+        self.status = status
+        self.content = content
+        # response headers, for Retry-After
+        self.response = response
+
+
+class AsyncDriveClient:
+    """
+        Minimal async Drive v2 client.
+        get_access_token is a blocking function returning a valid access token, called in a thread for every
+        request, so a token refreshed ahead of its expiry (gdrive_token.TokenManager) is used right away;
+        it is called with refresh=True, forcing a refresh, after a 401.
+    """
+
+    def __init__(self, session, get_access_token, retry_policy=None, upload_url=UPLOAD_URL, files_url=FILES_URL,
+                 request_limiter=None, bytes_limiter=None):
+        self.session = session
+        self.get_access_token = get_access_token
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.upload_url = upload_url
+        self.files_url = files_url
+        self.request_limiter = request_limiter
+        self.bytes_limiter = bytes_limiter
+        self.token_lock = asyncio.Lock()
+
+    async def _token(self, refresh=False):
+        loop = asyncio.get_running_loop()
+        if not refresh:
+            return await loop.run_in_executor(None, self.get_access_token, False)
+        # one forced refresh at a time
+        async with self.token_lock:
+            return await loop.run_in_executor(None, self.get_access_token, True)
+
+    async def _throttle(self, body):
+        # token buckets block, keep them off the event loop
+        loop = asyncio.get_running_loop()
+        if self.request_limiter:
+            await loop.run_in_executor(None, self.request_limiter.acquire, 1)
+        if self.bytes_limiter and body:
+            await loop.run_in_executor(None, self.bytes_limiter.acquire, len(body))
+
+    async def request(self, method: str, url: str, expected=(200,), body=None, headers=None, params=None):
+        """ One HTTP request. Returns (status, headers, content), raises AsyncRequestError on other statuses """
+
+        import aiohttp
+
+        await self._throttle(body)
+        token = await self._token()
+        for refreshed in (False, True):
+            request_headers = dict(headers or {}, Authorization=f"Bearer {token}")
+            try:
+                async with self.session.request(method, url, data=body, headers=request_headers,
+                                                params=params) as response:
+                    content = await response.read()
+                    status, response_headers = response.status, response.headers
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                raise ConnectionError(f"{method} {url}: {err!r}") from err
+            if status == 401 and not refreshed:
+                token = await self._token(refresh=True)
+                continue
+            break
+        if status not in expected:
+            raise AsyncRequestError(f"{method} {url}: HTTP {status}", status, content, response_headers)
+        return status, response_headers, content
+
+    async def call(self, func, *args, **kwargs):
+        """ await func(*args, **kwargs), repeating it on retryable errors """
+
+        attempt = 1
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as err:
+                if not self.retry_policy.should_retry(err, attempt):
+                    raise
+                await asyncio.sleep(self.retry_policy.delay(err, attempt))
+                attempt += 1
+
+    async def get_folder_id_by_name(self, parent_folder_id: str, folder_name: str):
+        """ ID of folder_name in parent_folder_id or None """
+
+        params = {
+            'q': folder_query(parent_folder_id, folder_name),
+            'fields': 'items(id,title)',
+            'maxResults': '10',
+            'supportsTeamDrives': 'true',
+            'includeTeamDriveItems': 'true',
+        }
+        _, _, content = await self.call(self.request, 'GET', self.files_url, params=params)
+        for item in json.loads(content)['items']:
+            if item['title'] == folder_name:
+                return item['id']
+        return None
+
+    async def find_file(self, parent_folder_id: str, title: str, marker: str):
+        """ Resource of the file titled title in parent_folder_id created with upload marker marker, or None """
+
+        params = {
+            'q': files_query(parent_folder_id, title) + (
+                f" and properties has {{ key='{UPLOAD_MARKER_KEY}' and value='{escape_query_value(marker)}' and "
+                f"visibility='PRIVATE' }}"),
+            'maxResults': '10',
+            'supportsTeamDrives': 'true',
+            'includeTeamDriveItems': 'true',
+        }
+        _, _, content = await self.call(self.request, 'GET', self.files_url, params=params)
+        for item in json.loads(content)['items']:
+            if item['title'] == title:
+                return item
+        return None
+
+    async def upload_multipart(self, metadata: dict, data: bytes):
+        """
+            Create a file with metadata and content in one request.
+            The request is sent once: after a retryable error the file is looked up by its upload marker, and
+            the request is sent again only if Drive has not created the file.
+        """
+
+        marker = uuid.uuid4().hex
+        metadata = dict(metadata, properties=[{'key': UPLOAD_MARKER_KEY, 'value': marker, 'visibility': 'PRIVATE'}])
+        boundary = uuid.uuid4().hex
+        body = b''.join([
+            f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n".encode(),
+            json.dumps(metadata).encode(),
+            f"\r\n--{boundary}\r\nContent-Type: {metadata['mimeType']}\r\n\r\n".encode(),
+            data,
+            f"\r\n--{boundary}--".encode(),
+        ])
+        headers = {'Content-Type': f'multipart/related; boundary="{boundary}"'}
+        params = {'uploadType': 'multipart', 'supportsTeamDrives': 'true'}
+        parent_folder_id = metadata['parents'][0]['id'] if metadata.get('parents') else 'root'
+        attempt = 1
+        while True:
+            try:
+                _, _, content = await self.request('POST', self.upload_url, body=body, headers=headers,
+                                                   params=params)
+                return json.loads(content)
+            except Exception as err:
+                if not self.retry_policy.should_retry(err, attempt):
+                    raise
+                await asyncio.sleep(self.retry_policy.delay(err, attempt))
+                attempt += 1
+            # the failed request may have been applied nevertheless
+            resource = await self.find_file(parent_folder_id, metadata['title'], marker)
+            if resource is not None:
+                return resource
+
+    async def query_offset(self, session_uri: str, total_size: int):
+        """ (acknowledged offset, file resource or None) of a resumable session """
+
+        status, headers, content = await self.call(
+            self.request, 'PUT', session_uri, expected=(200, 201, 308),
+            headers={'Content-Range': f"bytes */{total_size}"})
+        if status == 308:
+            return parse_range_offset(headers), None
+        return total_size, json.loads(content)
+
+    async def upload_resumable(self, metadata: dict, file_path: str, total_size: int, chunk_size: int):
+        """ Create a file through a resumable session, chunk by chunk """
+
+        headers = {'Content-Type': 'application/json; charset=UTF-8', 'X-Upload-Content-Type': metadata['mimeType'],
+                   'X-Upload-Content-Length': str(total_size)}
+        params = {'uploadType': 'resumable', 'supportsTeamDrives': 'true'}
+        _, response_headers, _ = await self.call(self.request, 'POST', self.upload_url,
+                                                 body=json.dumps(metadata).encode(), headers=headers, params=params)
+        session_uri = response_headers['Location']
+
+        loop = asyncio.get_running_loop()
+        offset = 0
+        attempt = 1
+        with open(file_path, 'rb') as f:
+            while True:
+                f.seek(offset)
+                chunk = await loop.run_in_executor(None, f.read, chunk_size)
+                content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{total_size}"
+                try:
+                    status, response_headers, content = await self.request(
+                        'PUT', session_uri, expected=(200, 201, 308), body=chunk,
+                        headers={'Content-Range': content_range})
+                except Exception as err:
+                    # resend only what the server has not acknowledged
+                    if not self.retry_policy.should_retry(err, attempt):
+                        raise
+                    await asyncio.sleep(self.retry_policy.delay(err, attempt))
+                    attempt += 1
+                    offset, resource = await self.query_offset(session_uri, total_size)
+                    if resource is not None:
+                        return resource
+                    continue
+                if status != 308:
+                    return json.loads(content)
+                offset = parse_range_offset(response_headers)
+                attempt = 1
+
+    async def upload(self, file_path: str, parent_folder_id='', uploaded_file_name='', chunk_size=DEFAULT_CHUNK_SIZE):
+        """ Upload file, return the created file resource """
+
+        metadata = {'title': uploaded_file_name or os.path.basename(file_path),
+                    'mimeType': mimetypes.guess_type(file_path)[0] or 'application/octet-stream'}
+        if parent_folder_id:
+            metadata['parents'] = [{"kind": "drive#fileLink", "id": parent_folder_id}]
+        total_size = os.path.getsize(file_path)
+        if total_size <= chunk_size:
+            # up to a chunk, read off the event loop like the chunks of upload_resumable()
+            loop = asyncio.get_running_loop()
+            with open(file_path, 'rb') as f:
+                data = await loop.run_in_executor(None, f.read)
+            return await self.upload_multipart(metadata, data)
+        return await self.upload_resumable(metadata, file_path, total_size, chunk_size)
+
+
+def credentials_token_getter(credentials):
+    """ get_access_token function for AsyncDriveClient from oauth2client credentials """
+
+    def get_access_token(refresh=False):
+        if refresh:
+            import httplib2
+            credentials.refresh(httplib2.Http())
+        # refreshes the token if it has expired
+        return credentials.get_access_token().access_token
+
+    return get_access_token
+
+
+async def upload_files_async(credentials, files, parent_folder_id='', uploaded_file_name='',
+                             chunk_size=DEFAULT_CHUNK_SIZE, concurrency=100, retry_policy=None,
+                             request_limiter=None, bytes_limiter=None, parent_folder_name='', folder_found=None):
+    """
+        Upload files with at most concurrency uploads in flight. Returns {file: resource or exception}
+        With parent_folder_name the files go to that folder of the Drive root, looked up first on the same
+        session; folder_found(folder_id) is then called with its ID, e.g. to cache it.
+    """
+
+    try:
+        import aiohttp
+    except ImportError:
+        raise Exception("--engine async requires aiohttp: pip install aiohttp")
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        client = AsyncDriveClient(session, credentials_token_getter(credentials), retry_policy,
+                                  request_limiter=request_limiter, bytes_limiter=bytes_limiter)
+        if parent_folder_name:
+            parent_folder_id = await client.get_folder_id_by_name('root', parent_folder_name)
+            if not parent_folder_id:
+                raise Exception(f"Cannot find parent directory {parent_folder_name}")
+            print('title: %s, id: %s' % (parent_folder_name, parent_folder_id))
+            if folder_found:
+                folder_found(parent_folder_id)
+
+        async def upload_one(file_path):
+            async with semaphore:
+                print(f"Uploading file {file_path}")
+                return await client.upload(file_path, parent_folder_id, uploaded_file_name, chunk_size)
+
+        results = await asyncio.gather(*[upload_one(file_path) for file_path in files], return_exceptions=True)
+    return dict(zip(files, results))
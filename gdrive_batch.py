@@ -0,0 +1,76 @@
+"""
+Batched Drive metadata requests.
+
+Up to 100 API calls (files().insert/get/list/patch/update requests without media) are sent in one multipart
+request to the Drive batch endpoint, see https://developers.google.com/drive/api/v2/batch.
+Items that fail with a retryable error are sent again in the next batch. Requests that must not be applied twice
+(e.g. creating a folder) go into a batch with idempotent=False, which is sent once: a failed batch or item may
+have been applied anyway, so the caller has to check before queuing it again.
+"""
+
+from gdrive_retry import RetryPolicy
+
+MAX_BATCH_SIZE = 100
+
+
+class MetadataBatch:
+    """
+        Collects googleapiclient requests (e.g. service.files().insert(body=...)) and executes them
+        in as few batch requests as possible.
+    """
+
+    def __init__(self, service, http=None, retry_policy=None, idempotent=True):
+        self.service = service
+        self.http = http
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.idempotent = idempotent
+        self.requests = {}
+
+    def add(self, request, key):
+        """ Queue request, its result will be returned under key """
+
+        self.requests[key] = request
+
+    def _execute_batch(self, keys):
+        """ Send one batch, return {key: response or exception} """
+
+        results = {}
+
+        def callback(request_id, response, exception):
+            results[ids[request_id]] = exception if exception is not None else response
+
+        ids = {}
+        batch = self.service.new_batch_http_request(callback=callback)
+        for number, key in enumerate(keys):
+            ids[str(number)] = key
+            batch.add(self.requests[key], request_id=str(number))
+        if self.idempotent:
+            # a failure of the whole batch (connection error, 5xx) is retried as a whole
+            self.retry_policy.call(batch.execute, http=self.http)
+            return results
+        try:
+            batch.execute(http=self.http)
+        except Exception as err:
+            # which items were applied is unknown, all without a response failed with err
+            for key in keys:
+                results.setdefault(key, err)
+        return results
+
+    def execute(self):
+        """ Execute all queued requests, return {key: response or exception} """
+
+        results = {}
+        pending = list(self.requests)
+        attempt = 1
+        while pending:
+            for start in range(0, len(pending), MAX_BATCH_SIZE):
+                results.update(self._execute_batch(pending[start:start + MAX_BATCH_SIZE]))
+            failed = [key for key in pending if isinstance(results[key], Exception)]
+            retryable = [key for key in failed if self.retry_policy.should_retry(results[key], attempt)]
+            if not retryable or not self.idempotent:
+                break
+            self.retry_policy.wait(results[retryable[0]], attempt)
+            attempt += 1
+            pending = retryable
+        self.requests = {}
+        return results
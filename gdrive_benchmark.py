@@ -0,0 +1,314 @@
+"""
+Benchmarks of gdrive_upload.py against a local fake Google Drive (gdrive_fake_drive.py).
+
+Usage:
+    python gdrive_benchmark.py (optional) --scenario {huge_file,tiny_files,deep_tree,large_listing,startup} ...
+        --latency MS --bandwidth RATE --error-rate RATE --error-status STATUS --retry-delay SECONDS --jobs N
+        --chunk-size SIZE --huge-file-size SIZE --tiny-files N --tree-depth N --tree-width N --listing-size N
+        --repeat N --startup-budget MS --output RESULTS_FILE
+
+Scenarios:
+    huge_file       one --huge-file-size file through a resumable session in --chunk-size chunks
+    tiny_files      --tiny-files 1 KiB files with --jobs parallel uploads
+    deep_tree       --recursive upload of a tree --tree-depth levels deep, --tree-width folders per level
+    large_listing   list_folder_files() and get_folder_id_by_name() in a folder with --listing-size files
+    startup         --help of gdrive_upload.py in a new interpreter, checked against --startup-budget
+
+The scenarios run the real upload code (PyDrive, googleapiclient and the gdrive_* modules) with GDRIVE_API_ROOT
+pointing to the fake server and the caches in a temporary directory. Results are printed as one JSON document with
+wall time, throughput, request counts, retries and p50/p99 latencies (milliseconds) per scenario. With --output the
+document is also appended to the file as one line, to track results over time.
+"""
+
+from gdrive_fake_drive import FakeDrive
+from gdrive_size import parse_size
+
+from argparse import ArgumentParser
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCENARIOS = ['huge_file', 'tiny_files', 'deep_tree', 'large_listing', 'startup']
+TINY_FILE_SIZE = 1024
+# --help of gdrive_upload.py should start within this many milliseconds
+DEFAULT_STARTUP_BUDGET = 150
+
+
+def parse_args():
+    parser = ArgumentParser(description='Benchmark gdrive_upload.py against a local fake Google Drive')
+    parser.add_argument('--scenario', type=str, choices=SCENARIOS, nargs='+', default=SCENARIOS,
+                        help='Scenarios to run, all by default (optional)', required=False)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Milliseconds added to every fake Drive response (optional)', required=False)
+    parser.add_argument('--bandwidth', type=parse_size, default=0,
+                        help='Upload bandwidth of every connection to the fake Drive, e.g. 10M (optional)',
+                        required=False)
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Share of requests failing with --error-status, e.g. 0.01 (optional)', required=False)
+    parser.add_argument('--error-status', type=int, choices=[403, 429, 500, 503], default=503,
+                        help='Status of injected errors (optional)', required=False)
+    parser.add_argument('--retry-delay', type=float, default=0.1,
+                        help='Initial delay in seconds between retries (optional)', required=False)
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='Number of parallel uploads (optional)',
+                        required=False)
+    parser.add_argument('-cs', '--chunk-size', type=parse_size, default=8 * 1024 ** 2,
+                        help='Chunk size of the huge file upload (optional)', required=False)
+    parser.add_argument('--huge-file-size', type=parse_size, default=1024 ** 3,
+                        help='Size of the huge_file scenario file (optional)', required=False)
+    parser.add_argument('--tiny-files', type=int, default=10000,
+                        help='Number of files of the tiny_files scenario (optional)', required=False)
+    parser.add_argument('--tree-depth', type=int, default=8, help='Depth of the deep_tree scenario (optional)',
+                        required=False)
+    parser.add_argument('--tree-width', type=int, default=2,
+                        help='Subfolders per folder of the deep_tree scenario (optional)', required=False)
+    parser.add_argument('--listing-size', type=int, default=20000,
+                        help='Files in the folder of the large_listing scenario (optional)', required=False)
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Repetitions of the large_listing and startup measurements (optional)', required=False)
+    parser.add_argument('--startup-budget', type=float, default=DEFAULT_STARTUP_BUDGET,
+                        help='Allowed p50 milliseconds of gdrive_upload.py --help (optional)', required=False)
+    parser.add_argument('--output', type=str, help='Append the results as a JSON line to this file (optional)',
+                        required=False)
+    return parser.parse_args()
+
+
+def percentiles(seconds):
+    """ count, mean, p50, p99 and max in milliseconds of the measured durations """
+
+    if not seconds:
+        return {'count': 0}
+    values = sorted(seconds)
+
+    def rank(percent):
+        # nearest-rank percentile
+        return values[max(0, -(-len(values) * percent // 100) - 1)] * 1000
+
+    return {'count': len(values), 'mean': sum(values) / len(values) * 1000, 'p50': rank(50), 'p99': rank(99),
+            'max': values[-1] * 1000}
+
+
+class TimedHttp:
+    """ httplib2.Http-compatible wrapper recording the duration of every request """
+
+    def __init__(self, http, durations: list):
+        self.http = http
+        self.durations = durations
+
+    def request(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.http.request(*args, **kwargs)
+        finally:
+            self.durations.append(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+class Benchmark:
+    """ Fake Drive, PyDrive connection to it and the measurements of the running scenario """
+
+    def __init__(self, args, work_dir: str, fake: FakeDrive):
+        self.args = args
+        self.work_dir = work_dir
+        self.fake = fake
+        self.request_durations = []
+        self.operation_durations = []
+
+        import gdrive_upload
+        self.gdrive_upload = gdrive_upload
+        gdrive_upload.retry_policy.base_delay = args.retry_delay
+        self.drive = self.connect()
+
+    def connect(self):
+        from oauth2client.client import AccessTokenCredentials
+        from pydrive.auth import GoogleAuth
+        from pydrive.drive import GoogleDrive
+
+        gauth = GoogleAuth()
+        gauth.credentials = AccessTokenCredentials('benchmark', 'gdrive_benchmark')
+        # time every request of every thread, like configure_rate_limits() throttles them
+        get_http_object = gauth.Get_Http_Object
+        gauth.Get_Http_Object = lambda: TimedHttp(get_http_object(), self.request_durations)
+        self.gdrive_upload.authorize(gauth)
+        return GoogleDrive(gauth)
+
+    @contextlib.contextmanager
+    def measure(self, result: dict, files=0, size=0):
+        """ Fill result with the measurements of the scenario run inside the block """
+
+        self.fake.reset_stats()
+        self.request_durations.clear()
+        self.operation_durations.clear()
+        retries = self.gdrive_upload.retry_policy.retries
+        start = time.perf_counter()
+        # gdrive_upload.py prints a line per file
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+        seconds = time.perf_counter() - start
+        result.update(seconds=seconds, files=files, bytes=size, files_per_second=files / seconds,
+                      megabytes_per_second=size / 1024 ** 2 / seconds,
+                      retries=self.gdrive_upload.retry_policy.retries - retries,
+                      requests=dict(sorted(self.fake.stats.items())),
+                      request_latency=percentiles(self.request_durations))
+        if self.operation_durations:
+            result['upload_latency'] = percentiles(self.operation_durations)
+
+    @contextlib.contextmanager
+    def timed_uploads(self):
+        """ Record the duration of every gdrive_upload.upload() call, also those made by upload_files() etc. """
+
+        upload = self.gdrive_upload.upload
+
+        def timed_upload(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return upload(*args, **kwargs)
+            finally:
+                self.operation_durations.append(time.perf_counter() - start)
+
+        self.gdrive_upload.upload = timed_upload
+        try:
+            yield
+        finally:
+            self.gdrive_upload.upload = upload
+
+    def huge_file(self):
+        path = os.path.join(self.work_dir, 'huge.bin')
+        block = os.urandom(1024 ** 2)
+        with open(path, 'wb') as f:
+            for offset in range(0, self.args.huge_file_size, len(block)):
+                f.write(block[:self.args.huge_file_size - offset])
+        folder_id = self.fake.add_folder('huge_file')['id']
+        result = {'chunk_size': self.args.chunk_size}
+        try:
+            with self.measure(result, 1, self.args.huge_file_size), self.timed_uploads():
+                self.gdrive_upload.upload(self.drive, path, folder_id, chunk_size=self.args.chunk_size)
+        finally:
+            os.remove(path)
+        return result
+
+    def tiny_files(self):
+        local_dir = os.path.join(self.work_dir, 'tiny')
+        os.makedirs(local_dir)
+        files = []
+        for number in range(self.args.tiny_files):
+            files.append(os.path.join(local_dir, f'{number:06}.txt'))
+            with open(files[-1], 'wb') as f:
+                f.write(os.urandom(TINY_FILE_SIZE // 2).hex().encode())
+        folder_id = self.fake.add_folder('tiny_files')['id']
+        result = {'jobs': self.args.jobs}
+        try:
+            with self.measure(result, len(files), len(files) * TINY_FILE_SIZE), self.timed_uploads():
+                self.gdrive_upload.upload_files(self.drive, files, folder_id, jobs=self.args.jobs)
+        finally:
+            shutil.rmtree(local_dir)
+        return result
+
+    def deep_tree(self):
+        local_dir = os.path.join(self.work_dir, 'tree')
+        levels = [local_dir]
+        folders = 0
+        for depth in range(self.args.tree_depth):
+            children = []
+            for parent in levels:
+                for number in range(self.args.tree_width):
+                    children.append(os.path.join(parent, f'd{depth}_{number}'))
+                    os.makedirs(children[-1])
+            folders += len(children)
+            levels = children
+        files = 0
+        for directory, _, _ in os.walk(local_dir):
+            with open(os.path.join(directory, 'file.txt'), 'wb') as f:
+                f.write(b'x' * TINY_FILE_SIZE)
+            files += 1
+        folder_id = self.fake.add_folder('deep_tree')['id']
+        result = {'depth': self.args.tree_depth, 'width': self.args.tree_width, 'folders': folders,
+                  'jobs': self.args.jobs}
+        try:
+            with self.measure(result, files, files * TINY_FILE_SIZE), self.timed_uploads():
+                self.gdrive_upload.upload_tree(self.drive, local_dir, folder_id, jobs=self.args.jobs)
+        finally:
+            shutil.rmtree(local_dir)
+        return result
+
+    def large_listing(self):
+        folder_id = self.fake.add_folder('large_listing')['id']
+        for number in range(self.args.listing_size):
+            self.fake.add_file(f'{number:06}.txt', folder_id)
+        # the folder looked up is the last one created
+        self.fake.add_folder('target', folder_id)
+        list_durations, lookup_durations = [], []
+        result = {'listing_size': self.args.listing_size}
+        with self.measure(result):
+            for _ in range(self.args.repeat):
+                start = time.perf_counter()
+                listed = self.gdrive_upload.list_folder_files(self.drive, folder_id)
+                list_durations.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                found = self.gdrive_upload.get_folder_id_by_name(self.drive, folder_id, 'target')
+                lookup_durations.append(time.perf_counter() - start)
+        if len(listed) != self.args.listing_size or not found:
+            raise Exception(f"Listing returned {len(listed)} files, folder found: {found}")
+        result.update(list_latency=percentiles(list_durations), lookup_latency=percentiles(lookup_durations))
+        return result
+
+    def startup(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gdrive_upload.py')
+        durations = []
+        for _ in range(self.args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script, '--help'], stdout=subprocess.DEVNULL, check=True)
+            durations.append(time.perf_counter() - start)
+        latency = percentiles(durations)
+        return {'latency': latency, 'budget': self.args.startup_budget,
+                'within_budget': latency['p50'] <= self.args.startup_budget}
+
+
+def main():
+    """ Main """
+
+    work_dir = tempfile.mkdtemp(prefix='gdrive_benchmark_')
+    fake = FakeDrive(seed=0)
+    # the gdrive_* modules read their cache directory and the API root when they are imported
+    os.environ['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')
+    os.environ['GDRIVE_API_ROOT'] = fake.start()
+    try:
+        args = parse_args()
+    except SystemExit:
+        fake.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    fake.latency = args.latency / 1000
+    fake.bandwidth = args.bandwidth
+    fake.error_rate = args.error_rate
+    fake.error_status = args.error_status
+
+    results = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'python': platform.python_version(),
+               'platform': platform.platform(),
+               'settings': {'latency_ms': args.latency, 'bandwidth': args.bandwidth, 'error_rate': args.error_rate,
+                            'error_status': args.error_status},
+               'scenarios': {}}
+    try:
+        benchmark = Benchmark(args, work_dir, fake)
+        for scenario in args.scenario:
+            print(f"Running {scenario}", file=sys.stderr)
+            results['scenarios'][scenario] = getattr(benchmark, scenario)()
+    finally:
+        fake.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Small on-disk caches shared by gdrive_upload.py runs.
+
+Everything is kept under ~/.cache/gdrive_upload (or $XDG_CACHE_HOME/gdrive_upload).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'gdrive_upload')
+FOLDER_CACHE_FILE = os.path.join(CACHE_DIR, 'folders.json')
+DEFAULT_FOLDER_CACHE_TTL = 3600
+# Root URL of Google APIs, $GDRIVE_API_ROOT sends all Drive requests to another server (e.g. gdrive_fake_drive.py)
+DEFAULT_API_ROOT = 'https://www.googleapis.com/'
+API_ROOT = (os.environ.get('GDRIVE_API_ROOT') or DEFAULT_API_ROOT).rstrip('/') + '/'
+DISCOVERY_URL = API_ROOT + 'discovery/v1/apis/drive/v2/rest'
+# the discovery document names the server requests are sent to, keep one per API root
+DISCOVERY_CACHE_FILE = os.path.join(CACHE_DIR, 'discovery', 'drive-v2.json' if API_ROOT == DEFAULT_API_ROOT else
+                                    f"drive-v2-{hashlib.sha1(API_ROOT.encode()).hexdigest()[:12]}.json")
+# The Drive v2 discovery document practically never changes, fetch it again once a month
+DISCOVERY_CACHE_TTL = 30 * 24 * 3600
+
+
+def write_text_atomic(path: str, text: str, mode=0o666):
+    """
+        Write text to path through a temporary file, so readers never see a half-written file.
+        A new file gets mode (less the umask), e.g. 0o600 for secrets.
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json_atomic(path: str, data, mode=0o666):
+    """ write_text_atomic() of data as JSON """
+
+    write_text_atomic(path, json.dumps(data), mode)
+
+
+class FolderCache:
+    """ (account, parent folder ID, folder name) -> folder ID, each entry valid for ttl seconds """
+
+    def __init__(self, path=FOLDER_CACHE_FILE, ttl=DEFAULT_FOLDER_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(account: str, parent_folder_id: str, folder_name: str):
+        return json.dumps([account, parent_folder_id, folder_name])
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, account: str, parent_folder_id: str, folder_name: str):
+        """ Return cached folder ID or None if it is missing or expired """
+
+        if self.ttl <= 0:
+            return None
+        entry = self._load().get(self._key(account, parent_folder_id, folder_name))
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['id']
+        return None
+
+    def set(self, account: str, parent_folder_id: str, folder_name: str, folder_id: str):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            entries = self._load()
+            now = time.time()
+            # drop expired entries while we are at it
+            entries = {key: entry for key, entry in entries.items() if now - entry['time'] < self.ttl}
+            entries[self._key(account, parent_folder_id, folder_name)] = {'id': folder_id, 'time': now}
+            write_json_atomic(self.path, entries)
+
+    def invalidate(self, account: str, parent_folder_id: str, folder_name: str):
+        with self.lock:
+            entries = self._load()
+            if entries.pop(self._key(account, parent_folder_id, folder_name), None) is not None:
+                write_json_atomic(self.path, entries)
+
+
+def load_discovery_document(http, path=DISCOVERY_CACHE_FILE, url=DISCOVERY_URL, ttl=DISCOVERY_CACHE_TTL):
+    """
+        Drive v2 discovery document (JSON string) for googleapiclient.discovery.build_from_document().
+        Read from the cache file, fetched with http only when the cache is missing or older than ttl.
+    """
+
+    try:
+        age = time.time() - os.path.getmtime(path)
+        with open(path) as f:
+            document = f.read()
+    except OSError:
+        age, document = None, None
+    if document is not None and age < ttl:
+        return document
+
+    try:
+        response, content = http.request(url, 'GET')
+        if response.status != 200:
+            raise Exception(f"Cannot fetch discovery document: HTTP {response.status}")
+    except Exception:
+        # an outdated document is still better than no document
+        if document is not None:
+            return document
+        raise
+    document = content.decode('utf-8')
+    write_text_atomic(path, document)
+    return document
@@ -0,0 +1,98 @@
+"""
+On-the-fly compression of uploads (gdrive_upload.py --compress gzip|zstd).
+
+A compressor thread reads the source and compresses it while the upload thread sends the previous chunks, so
+compression and network transfer overlap. The compressed data is never stored on disk and at most QUEUE_SIZE blocks
+of it are held in memory.
+
+zstd compresses with all CPU cores and requires zstandard (pip install zstandard), which is imported only when
+used. gzip uses zlib from the standard library.
+"""
+
+import queue
+import threading
+import zlib
+
+from gdrive_resumable import put_unless_stopped
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+MIME_TYPES = {'gzip': 'application/gzip', 'zstd': 'application/zstd'}
+READ_BLOCK_SIZE = 1024 * 1024
+# compressed blocks waiting for the uploader
+QUEUE_SIZE = 16
+
+
+def make_compressor(method: str, level=None):
+    """ Object with compress(data) and flush() producing a gzip or zstd stream """
+
+    if method == 'gzip':
+        # wbits 31: gzip header and trailer
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, 31)
+    if method == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("--compress zstd requires zstandard: pip install zstandard")
+        # threads=-1: one compression worker per CPU core
+        return zstandard.ZstdCompressor(level=3 if level is None else level, threads=-1).compressobj()
+    raise ValueError(f"Unknown compression {method}")
+
+
+class CompressedStream:
+    """
+        Binary stream of the compressed content of source (a binary file object), compressed by a background thread.
+        read(size) returns less than size bytes only at the end of the stream, like a buffered file.
+    """
+
+    def __init__(self, source, method: str, level=None):
+        self.source = source
+        self.compressor = make_compressor(method, level)
+        self.blocks = queue.Queue(QUEUE_SIZE)
+        self.buffer = bytearray()
+        self.eof = False
+        self.error = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._compress, name='compressor', daemon=True)
+        self.thread.start()
+
+    def _put(self, block):
+        # the reader is gone when the upload failed
+        put_unless_stopped(self.blocks, block, self.stopped)
+
+    def _compress(self):
+        try:
+            while not self.stopped.is_set():
+                data = self.source.read(READ_BLOCK_SIZE)
+                if not data:
+                    break
+                compressed = self.compressor.compress(data)
+                if compressed:
+                    self._put(compressed)
+            self._put(self.compressor.flush())
+        except Exception as err:
+            self.error = err
+        self._put(None)
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            block = self.blocks.get()
+            if block is None:
+                self.eof = True
+                if self.error is not None:
+                    raise Exception(f"Compression failed: {self.error}") from self.error
+            else:
+                self.buffer += block
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.stopped.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,534 @@
+"""
+In-process fake of the Google Drive REST API, used by gdrive_benchmark.py.
+
+Serves enough of Drive v2 for gdrive_upload.py (discovery document, files.list with q filters and paging,
+files.insert/get/update/patch/delete, multipart and resumable media uploads, batch requests) and the v3 files.list and
+files.create equivalents. Uploaded content is counted and hashed, not stored.
+
+Latency (added to every response), bandwidth (of request bodies, per connection) and error injection (a share of
+requests answered with 503, 429 or a rate limit 403) are configurable.
+Point gdrive_upload.py at it with GDRIVE_API_ROOT=http://127.0.0.1:PORT/.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# bytes of a request body read at once when bandwidth is limited
+READ_BLOCK_SIZE = 64 * 1024
+
+ERROR_REASONS = {403: 'userRateLimitExceeded', 429: 'rateLimitExceeded', 500: 'backendError', 503: 'backendError'}
+
+# one condition of a files.list query: 'ID' in parents, title = 'X', mimeType != 'Y', trashed = false,
+# properties has { key='K' and value='V' and visibility='PRIVATE' }
+QUERY_CLAUSE = re.compile(r"'((?:[^'\\]|\\.)*)'\s+in\s+parents"
+                          r"|(title|name|mimeType)\s*(=|!=)\s*'((?:[^'\\]|\\.)*)'"
+                          r"|trashed\s*=\s*(true|false)"
+                          r"|properties\s+has\s*\{\s*key\s*=\s*'((?:[^'\\]|\\.)*)'"
+                          r"\s+and\s+value\s*=\s*'((?:[^'\\]|\\.)*)'\s+and\s+visibility\s*=\s*'(PUBLIC|PRIVATE)'\s*\}")
+
+
+def unescape(value: str):
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+def discovery_document(root_url: str):
+    """ Drive v2 discovery document with the methods and parameters gdrive_upload.py uses, served by root_url """
+
+    def query(kind='string'):
+        return {'type': kind, 'location': 'query'}
+
+    file_id = {'type': 'string', 'location': 'path', 'required': True}
+    drives = {name: query('boolean') for name in ('supportsTeamDrives', 'supportsAllDrives', 'includeTeamDriveItems',
+                                                  'includeItemsFromAllDrives')}
+    write = dict(drives, **{name: query('boolean') for name in ('convert', 'ocr', 'pinned', 'useContentAsIndexableText',
+                                                                'newRevision', 'setModifiedDate', 'updateViewedDate')},
+                 **{name: query() for name in ('ocrLanguage', 'timedTextLanguage', 'timedTextTrackName',
+                                               'visibility', 'addParents', 'removeParents', 'modifiedDateBehavior')})
+
+    def media_upload(path):
+        return {'accept': ['*/*'], 'maxSize': '5120GB',
+                'protocols': {'simple': {'multipart': True, 'path': '/upload/drive/v2/' + path},
+                              'resumable': {'multipart': True, 'path': '/resumable/upload/drive/v2/' + path}}}
+
+    methods = {
+        'list': {'id': 'drive.files.list', 'path': 'files', 'httpMethod': 'GET', 'response': {'$ref': 'FileList'},
+                 'parameters': dict(drives, maxResults=query('integer'),
+                                    **{name: query() for name in ('q', 'pageToken', 'corpora', 'corpus', 'spaces',
+                                                                  'orderBy', 'projection', 'teamDriveId', 'driveId')})},
+        'get': {'id': 'drive.files.get', 'path': 'files/{fileId}', 'httpMethod': 'GET', 'parameterOrder': ['fileId'],
+                'response': {'$ref': 'File'},
+                'parameters': dict(drives, fileId=file_id, acknowledgeAbuse=query('boolean'),
+                                   updateViewedDate=query('boolean'), projection=query(), revisionId=query())},
+        'insert': {'id': 'drive.files.insert', 'path': 'files', 'httpMethod': 'POST', 'parameters': write,
+                   'request': {'$ref': 'File'}, 'response': {'$ref': 'File'},
+                   'supportsMediaUpload': True, 'mediaUpload': media_upload('files')},
+        'update': {'id': 'drive.files.update', 'path': 'files/{fileId}', 'httpMethod': 'PUT',
+                   'parameterOrder': ['fileId'], 'parameters': dict(write, fileId=file_id),
+                   'request': {'$ref': 'File'}, 'response': {'$ref': 'File'},
+                   'supportsMediaUpload': True, 'mediaUpload': media_upload('files/{fileId}')},
+        'patch': {'id': 'drive.files.patch', 'path': 'files/{fileId}', 'httpMethod': 'PATCH',
+                  'parameterOrder': ['fileId'], 'parameters': dict(write, fileId=file_id),
+                  'request': {'$ref': 'File'}, 'response': {'$ref': 'File'}},
+        'delete': {'id': 'drive.files.delete', 'path': 'files/{fileId}', 'httpMethod': 'DELETE',
+                   'parameterOrder': ['fileId'], 'parameters': dict(drives, fileId=file_id)},
+    }
+    return {
+        'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'id': 'drive:v2', 'name': 'drive',
+        'version': 'v2', 'title': 'Fake Drive API', 'protocol': 'rest', 'rootUrl': root_url,
+        'servicePath': 'drive/v2/', 'basePath': '/drive/v2/', 'baseUrl': root_url + 'drive/v2/',
+        'batchPath': 'batch/drive/v2',
+        'parameters': dict({name: query() for name in ('alt', 'fields', 'key', 'oauth_token', 'quotaUser', 'userIp')},
+                           prettyPrint=query('boolean')),
+        'schemas': {'File': {'id': 'File', 'type': 'object'}, 'FileList': {'id': 'FileList', 'type': 'object'}},
+        'resources': {'files': {'methods': methods}},
+    }
+
+
+def parse_multipart(body: bytes, content_type: str):
+    """ Contents of the parts of a multipart body """
+
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    parts = []
+    for part in body.split(b'--' + boundary)[1:]:
+        if part.startswith(b'--'):
+            break
+        # headers end with an empty line, \r\n or \n (email generators) separated
+        ends = [(part.find(separator), separator) for separator in (b'\r\n\r\n', b'\n\n') if separator in part]
+        position, separator = min(ends)
+        content = part[position + len(separator):]
+        # the line break before the next boundary belongs to the boundary
+        for line_break in (b'\r\n', b'\n'):
+            if content.endswith(line_break):
+                content = content[:-len(line_break)]
+                break
+        parts.append(content)
+    return parts
+
+
+class UploadSession:
+    """ State of a resumable upload """
+
+    def __init__(self, metadata: dict, version: str, size=None, file_id=''):
+        self.metadata = metadata
+        self.version = version
+        self.size = size
+        self.file_id = file_id
+        self.received = 0
+        self.md5 = hashlib.md5()
+        self.lock = threading.Lock()
+        # file resource once the upload is complete, sent back for any later request to the session
+        self.resource = None
+
+
+class FakeDrive:
+    """
+        File store and request dispatcher of the fake server. start() serves it on 127.0.0.1 and returns the API root.
+        stats counts requests per API method plus injected errors and received upload bytes.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=0, error_rate=0.0, error_status=503, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        # parent ID -> child IDs in creation order, (parent ID, title) -> IDs
+        self.children = {}
+        self.titles = {}
+        self.sessions = {}
+        self.stats = {}
+        self.server = None
+        self.root_url = ''
+
+    # --- store
+
+    def add_file(self, title: str, parent_id='root', mime_type='application/octet-stream', size=0, md5=''):
+        """ Create a file (without content) directly in the store and return its v2 resource """
+
+        with self.lock:
+            file_id = uuid.uuid4().hex
+            resource = {'kind': 'drive#file', 'id': file_id, 'title': title, 'mimeType': mime_type,
+                        'parents': [{'kind': 'drive#parentReference', 'id': parent_id, 'isRoot': parent_id == 'root'}],
+                        'labels': {'trashed': False}, 'createdDate': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                                                                     time.gmtime())}
+            if mime_type != FOLDER_MIME_TYPE:
+                resource['fileSize'] = str(size)
+                resource['md5Checksum'] = md5 or hashlib.md5(b'').hexdigest()
+            self.files[file_id] = resource
+            self.children.setdefault(parent_id, []).append(file_id)
+            self.titles.setdefault((parent_id, title), []).append(file_id)
+            return resource
+
+    def add_folder(self, title: str, parent_id='root'):
+        return self.add_file(title, parent_id, FOLDER_MIME_TYPE)
+
+    @staticmethod
+    def _parents(metadata: dict, version: str):
+        if version == 'v3':
+            return metadata.get('parents') or ['root']
+        return [parent['id'] for parent in metadata.get('parents') or [{'id': 'root'}]]
+
+    def _missing_parent(self, metadata: dict, version: str):
+        """ 404 response if a parent of the file to create does not exist (or is not a folder), else None """
+
+        for parent_id in self._parents(metadata, version):
+            if parent_id != 'root' and self.files.get(parent_id, {}).get('mimeType') != FOLDER_MIME_TYPE:
+                return self.json_response({'error': {'errors': [{'reason': 'notFound'}], 'code': 404,
+                                                     'message': f'File not found: {parent_id}'}}, 404)
+        return None
+
+    def _create(self, metadata: dict, version: str, size=0, md5=''):
+        title = metadata.get('name' if version == 'v3' else 'title', 'Untitled')
+        resource = self.add_file(title, self._parents(metadata, version)[0],
+                                 metadata.get('mimeType') or 'application/octet-stream', size, md5)
+        if version == 'v2' and metadata.get('properties'):
+            resource['properties'] = [{'kind': 'drive#property', 'key': prop['key'], 'value': prop['value'],
+                                       'visibility': prop.get('visibility', 'PRIVATE')}
+                                      for prop in metadata['properties']]
+        return resource
+
+    def _update(self, file_id: str, metadata: dict, size=None, md5=''):
+        with self.lock:
+            resource = self.files[file_id]
+            if metadata.get('title', resource['title']) != resource['title']:
+                for parent in resource['parents']:
+                    self.titles[(parent['id'], resource['title'])].remove(file_id)
+                    self.titles.setdefault((parent['id'], metadata['title']), []).append(file_id)
+            for key in ('title', 'mimeType', 'description'):
+                if key in metadata:
+                    resource[key] = metadata[key]
+            if size is not None:
+                resource['fileSize'] = str(size)
+                resource['md5Checksum'] = md5
+            return resource
+
+    @staticmethod
+    def to_v3(resource: dict):
+        converted = {'kind': 'drive#file', 'id': resource['id'], 'name': resource['title'],
+                     'mimeType': resource['mimeType'], 'parents': [parent['id'] for parent in resource['parents']]}
+        if 'fileSize' in resource:
+            converted['size'] = resource['fileSize']
+            converted['md5Checksum'] = resource['md5Checksum']
+        return converted
+
+    def query(self, q: str):
+        """ Files matching a files.list query, in creation order """
+
+        conditions = []
+        parent_id = title = None
+        for match in QUERY_CLAUSE.finditer(q or ''):
+            if match.group(1) is not None:
+                parent_id = unescape(match.group(1))
+            elif match.group(2) is not None:
+                field = 'title' if match.group(2) == 'name' else match.group(2)
+                value = unescape(match.group(4))
+                if field == 'title' and match.group(3) == '=':
+                    title = value
+                conditions.append((field, match.group(3) == '=', value))
+            elif match.group(5) is not None:
+                trashed = match.group(5) == 'true'
+                conditions.append(('trashed', True, trashed))
+            else:
+                conditions.append(('properties', True,
+                                   (unescape(match.group(6)), unescape(match.group(7)), match.group(8))))
+        with self.lock:
+            if parent_id is not None and title is not None:
+                candidates = list(self.titles.get((parent_id, title), []))
+            elif parent_id is not None:
+                candidates = list(self.children.get(parent_id, []))
+            else:
+                candidates = list(self.files)
+            resources = [self.files[file_id] for file_id in candidates]
+        matches = []
+        for resource in resources:
+            for field, equal, value in conditions:
+                if field == 'trashed':
+                    actual = resource['labels']['trashed']
+                elif field == 'properties':
+                    properties = {(prop['key'], prop['value'], prop['visibility'])
+                                  for prop in resource.get('properties', [])}
+                    actual = value if value in properties else None
+                else:
+                    actual = resource.get(field)
+                if (actual == value) != equal:
+                    break
+            else:
+                matches.append(resource)
+        return matches
+
+    # --- requests
+
+    def count(self, name: str, amount=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+
+    def inject_error(self):
+        """ Error response for a share of error_rate requests, None for the others """
+
+        with self.lock:
+            failing = self.error_rate and self.random.random() < self.error_rate
+        if not failing:
+            return None
+        self.count('injected_errors')
+        reason = ERROR_REASONS.get(self.error_status, 'backendError')
+        return self.json_response({'error': {'errors': [{'domain': 'usageLimits', 'reason': reason,
+                                                         'message': 'Injected error'}],
+                                             'code': self.error_status, 'message': 'Injected error'}},
+                                  self.error_status)
+
+    @staticmethod
+    def json_response(data, status=200, headers=None):
+        return status, dict(headers or {}, **{'Content-Type': 'application/json; charset=UTF-8'}), \
+            json.dumps(data).encode()
+
+    def dispatch(self, method: str, path: str, params: dict, headers: dict, body: bytes):
+        """ Handle one API request, return (status, headers, body) """
+
+        if path.endswith('/discovery/v1/apis/drive/v2/rest'):
+            self.count('discovery')
+            return self.json_response(discovery_document(self.root_url))
+        error = self.inject_error()
+        if error is not None:
+            # an upload chunk that failed is lost
+            return error
+        match = re.match(r'/(upload/)?drive/(v2|v3)/files(?:/([^/]+))?$', path)
+        if match:
+            media, version, file_id = match.groups()
+            if media:
+                return self.media(method, version, file_id, params, headers, body)
+            return self.metadata(method, version, file_id, params, body)
+        match = re.match(r'/upload/session/([0-9a-f]+)$', path)
+        if match and method == 'PUT':
+            return self.upload_chunk(match.group(1), headers, body)
+        if path.startswith('/batch'):
+            return self.batch(headers, body)
+        return self.json_response({'error': {'code': 404, 'message': f'Unknown path {path}'}}, 404)
+
+    def metadata(self, method: str, version: str, file_id: str, params: dict, body: bytes):
+        if file_id is None and method == 'GET':
+            self.count('files.list')
+            matches = self.query(params.get('q', ''))
+            page_size = int(params.get('maxResults') or params.get('pageSize') or DEFAULT_PAGE_SIZE)
+            page_size = min(page_size, MAX_PAGE_SIZE)
+            start = int(params.get('pageToken') or 0)
+            page = matches[start:start + page_size]
+            if version == 'v3':
+                result = {'kind': 'drive#fileList', 'files': [self.to_v3(item) for item in page]}
+            else:
+                result = {'kind': 'drive#fileList', 'items': page}
+            if start + page_size < len(matches):
+                result['nextPageToken'] = str(start + page_size)
+            return self.json_response(result)
+        if file_id is None and method == 'POST':
+            self.count('files.insert')
+            metadata = json.loads(body or b'{}')
+            missing_parent = self._missing_parent(metadata, version)
+            if missing_parent:
+                return missing_parent
+            resource = self._create(metadata, version)
+            return self.json_response(self.to_v3(resource) if version == 'v3' else resource)
+        if file_id not in self.files:
+            return self.json_response({'error': {'errors': [{'reason': 'notFound'}], 'code': 404,
+                                                 'message': f'File not found: {file_id}'}}, 404)
+        if method == 'GET':
+            self.count('files.get')
+            resource = self.files[file_id]
+        elif method in ('PUT', 'PATCH'):
+            self.count('files.update')
+            resource = self._update(file_id, json.loads(body or b'{}'))
+        elif method == 'DELETE':
+            self.count('files.delete')
+            with self.lock:
+                resource = self.files.pop(file_id)
+                for parent in resource['parents']:
+                    self.children[parent['id']].remove(file_id)
+                    self.titles[(parent['id'], resource['title'])].remove(file_id)
+            return 204, {}, b''
+        else:
+            return self.json_response({'error': {'code': 405, 'message': 'Method not allowed'}}, 405)
+        return self.json_response(self.to_v3(resource) if version == 'v3' else resource)
+
+    def media(self, method: str, version: str, file_id: str, params: dict, headers: dict, body: bytes):
+        upload_type = params.get('uploadType', 'media')
+        if file_id is not None and file_id not in self.files:
+            return self.json_response({'error': {'errors': [{'reason': 'notFound'}], 'code': 404,
+                                                 'message': f'File not found: {file_id}'}}, 404)
+        if upload_type == 'resumable':
+            self.count('upload.start')
+            size = headers.get('x-upload-content-length')
+            metadata = json.loads(body or b'{}')
+            missing_parent = None if file_id else self._missing_parent(metadata, version)
+            if missing_parent:
+                return missing_parent
+            session_id = uuid.uuid4().hex
+            with self.lock:
+                self.sessions[session_id] = UploadSession(metadata, version,
+                                                          int(size) if size else None, file_id or '')
+            return 200, {'Location': f"{self.root_url}upload/session/{session_id}", 'Content-Length': '0'}, b''
+
+        self.count(f'upload.{upload_type}')
+        if upload_type == 'multipart':
+            metadata, content = parse_multipart(body, headers.get('content-type', ''))
+            metadata = json.loads(metadata or b'{}')
+        else:
+            metadata, content = {}, body
+        missing_parent = None if file_id else self._missing_parent(metadata, version)
+        if missing_parent:
+            return missing_parent
+        self.count('upload_bytes', len(content))
+        md5 = hashlib.md5(content).hexdigest()
+        if file_id:
+            resource = self._update(file_id, metadata, len(content), md5)
+        else:
+            resource = self._create(metadata, version, len(content), md5)
+        return self.json_response(self.to_v3(resource) if version == 'v3' else resource)
+
+    def upload_chunk(self, session_id: str, headers: dict, body: bytes):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return self.json_response({'error': {'code': 404, 'message': 'Upload session not found'}}, 404)
+        content_range = headers.get('content-range', '')
+        match = re.match(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', content_range)
+        if not match:
+            return self.json_response({'error': {'code': 400, 'message': f'Bad Content-Range {content_range}'}}, 400)
+        first, _, total = match.groups()
+        self.count('upload.chunk' if first is not None else 'upload.status')
+        with session.lock:
+            if session.resource is not None:
+                return self.json_response(self.to_v3(session.resource) if session.version == 'v3'
+                                          else session.resource)
+            if total != '*':
+                session.size = int(total)
+            if first is not None and int(first) <= session.received:
+                # a resent chunk may overlap what was already received
+                new_data = body[session.received - int(first):]
+                session.md5.update(new_data)
+                session.received += len(new_data)
+                self.count('upload_bytes', len(new_data))
+            if session.size is None or session.received < session.size:
+                headers = {'Content-Length': '0'}
+                if session.received:
+                    headers['Range'] = f"bytes=0-{session.received - 1}"
+                return 308, headers, b''
+            md5 = session.md5.hexdigest()
+            if session.file_id:
+                session.resource = self._update(session.file_id, session.metadata, session.received, md5)
+            else:
+                session.resource = self._create(session.metadata, session.version, session.received, md5)
+        return self.json_response(self.to_v3(session.resource) if session.version == 'v3' else session.resource)
+
+    def batch(self, headers: dict, body: bytes):
+        self.count('batch')
+        content_type = headers.get('content-type', '')
+        boundary = 'batch_' + uuid.uuid4().hex
+        response = []
+        for part in re.split(rb'--' + re.escape(re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode())
+                             + rb'(?:--)?', body)[1:]:
+            if not part.strip():
+                continue
+            part_headers, _, request = part.replace(b'\r\n', b'\n').strip(b'\n').partition(b'\n\n')
+            content_id = re.search(rb'(?i)content-id:\s*<([^>]*)>', part_headers).group(1).decode()
+            request_head, _, request_body = request.partition(b'\n\n')
+            request_line, *header_lines = request_head.decode().split('\n')
+            method, uri = request_line.split(' ')[:2]
+            request_headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(':')
+                request_headers[name.strip().lower()] = value.strip()
+            uri = urllib.parse.urlsplit(uri)
+            params = dict(urllib.parse.parse_qsl(uri.query))
+            status, _, content = self.dispatch(method, uri.path, params, request_headers, request_body.strip())
+            response.append(f"--{boundary}\r\nContent-Type: application/http\r\n"
+                            f"Content-ID: <response-{content_id}>\r\n\r\n"
+                            f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+                            f"Content-Type: application/json; charset=UTF-8\r\n"
+                            f"Content-Length: {len(content)}\r\n\r\n".encode() + content + b"\r\n")
+        response.append(f"--{boundary}--\r\n".encode())
+        return 200, {'Content-Type': f'multipart/mixed; boundary={boundary}'}, b''.join(response)
+
+    # --- server
+
+    def start(self):
+        """ Serve on a free local port in a background thread, return the API root URL """
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeDriveHandler)
+        self.server.daemon_threads = True
+        self.server.drive = self
+        self.root_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target=self.server.serve_forever, name='fake-drive', daemon=True).start()
+        return self.root_url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    """ HTTP/1.1 keep-alive handler passing every request to the server's FakeDrive """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.drive.count('connections')
+
+    def read_body(self):
+        drive = self.server.drive
+        remaining = int(self.headers.get('Content-Length') or 0)
+        blocks = []
+        while remaining:
+            block = self.rfile.read(min(remaining, READ_BLOCK_SIZE))
+            if not block:
+                break
+            remaining -= len(block)
+            blocks.append(block)
+            if drive.bandwidth:
+                time.sleep(len(block) / drive.bandwidth)
+        return b''.join(blocks)
+
+    def handle_request(self):
+        drive = self.server.drive
+        body = self.read_body()
+        uri = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(uri.query))
+        headers = {name.lower(): value for name, value in self.headers.items()}
+        status, response_headers, content = drive.dispatch(self.command, uri.path, params, headers, body)
+        if drive.latency:
+            time.sleep(drive.latency)
+        self.send_response(status)
+        for name, value in response_headers.items():
+            if name.lower() != 'content-length':
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
@@ -0,0 +1,54 @@
+"""
+Memory accounting of uploads (gdrive_upload.py --max-memory).
+
+Resumable and stream uploads hold at most a few chunks at a time, so memory depends on the chunk size and the
+number of parallel uploads, never on the file size. MemoryBudget additionally caps the chunk buffers in flight
+across all uploads of a process: an upload waits for memory instead of exceeding the budget.
+"""
+
+import sys
+import threading
+
+
+class MemoryBudget:
+    """
+        Counting semaphore of bytes. A request bigger than the whole limit is granted once nothing else is
+        reserved, so a single chunk larger than the budget cannot deadlock.
+    """
+
+    def __init__(self, limit: int):
+        if limit <= 0:
+            raise ValueError("Memory limit must be positive")
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size: int, stopped=None):
+        """ Reserve size bytes, waiting until they are available. Returns False if stopped (an Event) is set """
+
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                if stopped is not None and stopped.is_set():
+                    return False
+                self.condition.wait(1 if stopped is not None else None)
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, size: int):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes, None where unknown (Windows) """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,129 @@
+"""
+Prometheus metrics of uploads (gdrive_upload.py --metrics-file and --metrics-port).
+
+The counters of a Stats (gdrive_stats) are rendered in the Prometheus text exposition format, which Prometheus and
+OpenMetrics scrapers both accept, so no client library is needed. A batch run writes them once at exit to a file
+for node_exporter's textfile collector; the upload daemon serves them on http://127.0.0.1:PORT/metrics.
+See https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from gdrive_cache import write_text_atomic
+from gdrive_stats import PHASES, phase_order
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(value: str):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """ Text exposition of metric families, each with HELP and TYPE """
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name: str, kind: str, help_text: str):
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name: str, value, **labels):
+        if labels:
+            label_text = ','.join(f'{key}="{escape_label(str(label))}"' for key, label in labels.items())
+            name = f"{name}{{{label_text}}}"
+        self.lines.append(f"{name} {format_value(value)}")
+
+    def histogram(self, name: str, histogram, **labels):
+        for bound, count in zip(histogram.buckets + [float('inf')], histogram.counts + [histogram.count]):
+            self.sample(name + '_bucket', count, **labels, le=format_value(float(bound)))
+        self.sample(name + '_sum', histogram.sum, **labels)
+        self.sample(name + '_count', histogram.count, **labels)
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render(stats, retries=0):
+    """ Metrics of stats (a gdrive_stats.Stats) and the retries of the run as exposition text """
+
+    metrics = Metrics()
+    with stats.lock:
+        metrics.family('gdrive_uploads_total', 'counter', 'Files uploaded')
+        metrics.sample('gdrive_uploads_total', stats.files)
+        metrics.family('gdrive_upload_failures_total', 'counter', 'Uploads that failed after all retries')
+        metrics.sample('gdrive_upload_failures_total', stats.failed)
+        metrics.family('gdrive_uploaded_bytes_total', 'counter', 'Bytes of uploaded files')
+        metrics.sample('gdrive_uploaded_bytes_total', stats.bytes)
+        metrics.family('gdrive_upload_duration_seconds', 'histogram', 'Time from the start to the end of an upload')
+        metrics.histogram('gdrive_upload_duration_seconds', stats.upload_seconds)
+        metrics.family('gdrive_uploads_in_flight', 'gauge', 'Uploads running')
+        metrics.sample('gdrive_uploads_in_flight', stats.in_flight)
+        metrics.family('gdrive_upload_queue_depth', 'gauge', 'Uploads waiting for a free job')
+        metrics.sample('gdrive_upload_queue_depth', stats.queued)
+
+        metrics.family('gdrive_request_duration_seconds', 'histogram', 'Drive API request latency by API method')
+        for method, histogram in sorted(stats.latency.items()):
+            metrics.histogram('gdrive_request_duration_seconds', histogram, method=method)
+        metrics.family('gdrive_request_errors_total', 'counter',
+                       'Drive API requests failed or answered with an HTTP error, by API method')
+        for method, totals in sorted(stats.requests.items()):
+            metrics.sample('gdrive_request_errors_total', totals['errors'], method=method)
+        metrics.family('gdrive_requests_throttled_total', 'counter', 'Drive API requests answered with 429')
+        for method, totals in sorted(stats.requests.items()):
+            metrics.sample('gdrive_requests_throttled_total', totals['throttled'], method=method)
+        metrics.family('gdrive_request_bytes_total', 'counter', 'Bytes of Drive API request bodies, by API method')
+        for method, totals in sorted(stats.requests.items()):
+            metrics.sample('gdrive_request_bytes_total', totals['bytes'], method=method)
+        metrics.family('gdrive_retries_total', 'counter', 'Drive API requests retried')
+        metrics.sample('gdrive_retries_total', retries)
+
+        metrics.family('gdrive_phase_seconds_total', 'counter', 'Time spent per phase, summed over parallel uploads')
+        for phase in sorted(set(PHASES) | set(stats.phases), key=phase_order):
+            metrics.sample('gdrive_phase_seconds_total', stats.phases.get(phase, [0, 0.0])[1], phase=phase)
+    return metrics.text()
+
+
+def write_textfile(path: str, stats, retries=0):
+    """ Write the metrics to path, atomically, as the textfile collector must never see a partial file """
+
+    write_text_atomic(path, render(stats, retries))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ GET /metrics """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render(self.server.stats, self.server.retries()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int, stats, retries=lambda: 0, host='127.0.0.1'):
+    """ Serve the metrics of stats on http://host:port/metrics from a daemon thread, return the server """
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.stats = stats
+    # called on every scrape, the retry count keeps growing
+    server.retries = retries
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
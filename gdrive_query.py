@@ -0,0 +1,27 @@
+"""
+Drive search query helpers shared by the upload engines (gdrive_upload.py and gdrive_async.py).
+See https://developers.google.com/drive/api/v2/search-files
+"""
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+def escape_query_value(value: str):
+    """ Escape a string literal for a Drive search query """
+
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def folder_query(parent_id: str, name: str):
+    """ Query for the folder titled name in parent_id """
+
+    return "'{0}' in parents and title = '{1}' and mimeType = '{2}' and trashed=false".format(
+        parent_id, escape_query_value(name), FOLDER_MIME_TYPE)
+
+
+def files_query(parent_id: str, title=''):
+    """ Query for the files (not folders) in parent_id, with title only those titled so """
+
+    title_clause = "title = '{0}' and ".format(escape_query_value(title)) if title else ''
+    return "'{0}' in parents and {1}mimeType != '{2}' and trashed=false".format(parent_id, title_clause,
+                                                                               FOLDER_MIME_TYPE)
@@ -0,0 +1,180 @@
+"""
+Client-side rate limiting of Google Drive requests (token buckets).
+
+Drive enforces per-user quotas (requests per 100 seconds). Spacing requests evenly keeps several parallel uploads, or
+several gdrive_upload.py processes sharing a limit file, just below the quota instead of bursting into 403/429 errors
+and backing off.
+
+The same buckets limit bandwidth, optionally following a BandwidthSchedule (e.g. throttled during office hours,
+unlimited at night).
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+
+from gdrive_size import parse_size
+from gdrive_stats import body_size
+
+
+def parse_bandwidth_window(value: str):
+    """ Parse HH:MM-HH:MM=RATE (e.g. 08:00-18:00=1M, rate 0 means unlimited) into (start, end, rate) """
+
+    try:
+        period, rate = value.split('=')
+        start, end = period.split('-')
+        minutes = []
+        for clock, latest in ((start, 23 * 60 + 59), (end, 24 * 60)):
+            hours, mins = (int(part) for part in clock.split(':'))
+            # 24:00 only ends a window, at midnight
+            if not (0 <= hours and 0 <= mins < 60 and hours * 60 + mins <= latest):
+                raise ValueError(clock)
+            minutes.append(hours * 60 + mins)
+        return minutes[0], minutes[1], parse_size(rate)
+    except ValueError:
+        raise ValueError(f"Invalid bandwidth window {value}, expected HH:MM-HH:MM=RATE")
+
+
+class BandwidthSchedule:
+    """
+        Rate limit depending on the local time of day: the rate of the first window containing the current time,
+        default_rate outside all windows. Windows may wrap around midnight (22:00-06:00). Rate 0 means unlimited.
+    """
+
+    def __init__(self, default_rate=0, windows=()):
+        self.default_rate = default_rate
+        self.windows = list(windows)
+
+    def rate_at(self, when=None):
+        when = when or datetime.datetime.now()
+        minute = when.hour * 60 + when.minute
+        for start, end, rate in self.windows:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.default_rate
+
+
+class TokenBucket:
+    """
+        rate tokens per second, at most capacity (one second worth by default) saved up for bursts.
+        acquire() of more tokens than available goes into debt and sleeps until it is paid off, so requests
+        bigger than the capacity (large chunks) are still limited to rate on average.
+        With a schedule (BandwidthSchedule) the rate follows the schedule and rate 0 lets everything through.
+    """
+
+    def __init__(self, rate: float, capacity=None, schedule=None):
+        self.schedule = schedule
+        if schedule is not None:
+            rate = schedule.rate_at()
+        elif rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _follow_schedule(self):
+        """ Update rate from the schedule. Returns False while unlimited """
+
+        if self.schedule is None:
+            return True
+        rate = self.schedule.rate_at()
+        if rate != self.rate:
+            self.rate = self.capacity = rate
+            self.tokens = min(self.tokens, rate)
+        return rate > 0
+
+    def _take(self, tokens, available, updated, now):
+        """ Refill by the time passed, take tokens. Returns (tokens left, seconds to wait) """
+
+        available = min(self.capacity, available + (now - updated) * self.rate) - tokens
+        return available, max(0.0, -available / self.rate)
+
+    def acquire(self, tokens=1):
+        """ Take tokens, sleeping as long as needed to stay under the rate """
+
+        with self.lock:
+            if not self._follow_schedule():
+                return
+            now = time.monotonic()
+            self.tokens, wait = self._take(tokens, self.tokens, self.updated, now)
+            self.updated = now
+        if wait:
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+        Token bucket whose state lives in a JSON file locked with flock(), shared by every process (and thread)
+        using the same file and name. Unix only.
+    """
+
+    def __init__(self, path: str, name: str, rate: float, capacity=None, schedule=None):
+        import fcntl  # Unix only, imported here to keep TokenBucket usable everywhere
+        super().__init__(rate, capacity, schedule)
+        self.fcntl = fcntl
+        self.path = path
+        self.name = name
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            if not self._follow_schedule():
+                return
+        with self.lock, open(self.path, 'a+') as f:
+            self.fcntl.flock(f, self.fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    buckets = json.loads(f.read() or '{}')
+                except ValueError:
+                    buckets = {}
+                # wall clock, monotonic clocks of different processes are not comparable
+                now = time.time()
+                state = buckets.get(self.name, {'tokens': self.capacity, 'updated': now})
+                available, wait = self._take(tokens, state['tokens'], state['updated'], now)
+                buckets[self.name] = {'tokens': available, 'updated': now}
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(buckets))
+                f.flush()
+            finally:
+                self.fcntl.flock(f, self.fcntl.LOCK_UN)
+        if wait:
+            time.sleep(wait)
+
+
+def make_bucket(rate: float, shared_file=None, name='', schedule=None):
+    """ TokenBucket, or SharedTokenBucket when shared_file is given. None if neither rate nor schedule is set """
+
+    if not rate and schedule is None:
+        return None
+    if shared_file:
+        return SharedTokenBucket(shared_file, name, rate, schedule=schedule)
+    return TokenBucket(rate, schedule=schedule)
+
+
+class ThrottledHttp:
+    """
+        httplib2.Http-compatible wrapper that takes one token from request_limiter per request and
+        one token per body byte from bytes_limiter before sending it.
+    """
+
+    def __init__(self, http, request_limiter=None, bytes_limiter=None):
+        self.http = http
+        self.request_limiter = request_limiter
+        self.bytes_limiter = bytes_limiter
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        if self.request_limiter:
+            self.request_limiter.acquire()
+        size = body_size(body, headers)
+        if self.bytes_limiter and size:
+            self.bytes_limiter.acquire(size)
+        return self.http.request(uri, method, body, headers, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
@@ -0,0 +1,465 @@
+"""
+Resumable (chunked) uploads using Google Drive's upload-session protocol.
+
+The file is sent in fixed-size chunks to a session URI. The session URI is persisted on disk, so if the
+upload is interrupted (network drop, killed process) the next run asks the server how many bytes it has
+already received and continues from that offset instead of starting from byte zero.
+
+Files are memory-mapped and hashed by a ChunkPipeline ahead of the chunk being sent, so disk reads, MD5 and network
+transfer overlap, and the upload is verified against the MD5 Drive computes. Chunks are memoryview slices of the
+mapping, sent without copying them into bytes objects.
+
+Protocol reference: https://developers.google.com/drive/api/v2/manage-uploads#resumable
+"""
+
+import hashlib
+import json
+import mimetypes
+import mmap
+import os
+import queue
+import threading
+import time
+
+from gdrive_cache import API_ROOT, CACHE_DIR, write_json_atomic
+from gdrive_retry import RetryPolicy
+from gdrive_stats import Stats
+
+UPLOAD_URL = API_ROOT + 'upload/drive/v2/files'
+# Drive requires every chunk except the last one to be a multiple of 256 KiB
+CHUNK_ALIGNMENT = 256 * 1024
+DEFAULT_CHUNK_SIZE = 32 * CHUNK_ALIGNMENT
+SESSION_DIR = os.path.join(CACHE_DIR, 'sessions')
+# chunks read ahead of the one being sent, per pipeline stage
+PREFETCH_CHUNKS = 2
+
+
+class ResumableUploadError(Exception):
+    """ Upload session returned an unexpected response """
+
+    def __init__(self, message, status=None, content=b'', response=None):
+        super().__init__(message)
+        self.status = status
+        self.content = content
+        self.response = response
+
+
+class SessionStore:
+    """
+        Keep session URIs of unfinished uploads on disk, one JSON file per upload.
+        A session URI lets anyone upload to it without credentials, so the files are readable by the owner only.
+    """
+
+    def __init__(self, directory=SESSION_DIR):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, session):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        write_json_atomic(self._path(key), session, mode=0o600)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+def session_key(file_path: str, metadata: dict):
+    """ Identify an upload by the source file (path, size, mtime) and destination metadata """
+
+    stat = os.stat(file_path)
+    source = [os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, metadata]
+    return hashlib.sha1(json.dumps(source, sort_keys=True).encode()).hexdigest()
+
+
+def put_unless_stopped(items: queue.Queue, item, stopped: threading.Event):
+    """ Put item into items, waiting for room until stopped is set. Returns whether item was put """
+
+    # give up when the consumer is gone, instead of blocking forever on a full queue
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def parse_range_offset(response):
+    """ Return the next byte the server expects, from the Range header of a 308 response """
+
+    # Range: bytes=0-1048575. No Range header means nothing has been received yet
+    byte_range = response.get('range')
+    if not byte_range:
+        return 0
+    return int(byte_range.rsplit('-', 1)[1]) + 1
+
+
+class ChunkPipeline:
+    """
+        Read a file in chunks on a reader thread and hash them on a hasher thread, so reading, hashing and
+        sending of the previous chunk overlap. Iterating yields (offset, chunk) in file order, an empty file yields
+        one empty chunk. md5 is the hex digest of the whole file once all chunks were yielded.
+        With start the pipeline begins at the chunk containing byte start; the chunks before it are not read, nor
+        hashed, and md5 stays None.
+
+        The file is memory-mapped and chunks are memoryview slices of the mapping: the reader asks the kernel to
+        read ahead the chunks it queues (at most prefetch between each stage) and pages of chunks the consumer is
+        done with are dropped, so memory use does not grow with the file size. The file must not be truncated
+        while it is read. With memory_budget (gdrive_memory.MemoryBudget) every chunk is reserved from it
+        until the consumer is done with it.
+    """
+
+    def __init__(self, file_path: str, chunk_size: int, prefetch=PREFETCH_CHUNKS, memory_budget=None, start=0):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.start = start // chunk_size * chunk_size
+        self.memory_budget = memory_budget
+        self.reserved = 0
+        self.lock = threading.Lock()
+        self.read_queue = queue.Queue(prefetch)
+        self.hashed_queue = queue.Queue(prefetch)
+        self.md5 = None
+        self.mapped = None
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self._read, name='chunk-reader', daemon=True),
+                        threading.Thread(target=self._hash, name='chunk-hasher', daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def _put(self, chunks, item):
+        put_unless_stopped(chunks, item, self.stopped)
+
+    def _get(self, chunks):
+        """ Next item of chunks, None once the pipeline is closed: the reader may stop without queuing None """
+
+        while not self.stopped.is_set():
+            try:
+                return chunks.get(timeout=1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _read(self):
+        """ Queue (offset, chunk) items, then None. An error is queued instead of the rest """
+
+        try:
+            with open(self.file_path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if not size:
+                    # an empty file cannot be mapped
+                    self._put(self.read_queue, (0, b''))
+                    self._put(self.read_queue, None)
+                    return
+                # the mapping stays valid after the file is closed, and is unmapped with its last memoryview
+                self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._advise('MADV_SEQUENTIAL')
+            view = memoryview(self.mapped)
+            for offset in range(self.start, size, self.chunk_size):
+                if self.stopped.is_set():
+                    return
+                length = min(self.chunk_size, size - offset)
+                if not self._reserve(length):
+                    return
+                self._advise('MADV_WILLNEED', offset, length)
+                self._put(self.read_queue, (offset, view[offset:offset + length]))
+            self._put(self.read_queue, None)
+        except Exception as err:
+            self._put(self.read_queue, err)
+
+    def _reserve(self, size: int):
+        """ Take size bytes from the memory budget. False if the pipeline was closed meanwhile """
+
+        if self.memory_budget is None:
+            return True
+        if not self.memory_budget.acquire(size, self.stopped):
+            return False
+        with self.lock:
+            if self.stopped.is_set():
+                self.memory_budget.release(size)
+                return False
+            self.reserved += size
+        return True
+
+    def _release(self, size: int):
+        if self.memory_budget is None:
+            return
+        with self.lock:
+            size = min(size, self.reserved)
+            self.reserved -= size
+            self.memory_budget.release(size)
+
+    def _advise(self, advice: str, *byte_range):
+        """ madvise() the mapping, where supported (Unix, Python 3.8+) """
+
+        if hasattr(self.mapped, 'madvise') and hasattr(mmap, advice):
+            self.mapped.madvise(getattr(mmap, advice), *byte_range)
+
+    def _hash(self):
+        md5 = hashlib.md5()
+        while True:
+            item = self._get(self.read_queue)
+            if self.stopped.is_set():
+                return
+            # the MD5 of a part of the file would be of no use
+            if item is None and not self.start:
+                self.md5 = md5.hexdigest()
+            elif isinstance(item, tuple) and not self.start:
+                # hashlib releases the GIL for large buffers, this runs in parallel with the upload
+                md5.update(item[1])
+            self._put(self.hashed_queue, item)
+            if not isinstance(item, tuple):
+                return
+
+    def __iter__(self):
+        while True:
+            item = self.hashed_queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            offset, chunk = item
+            if len(chunk):
+                # sent, its pages can be read again from the file if needed
+                self._advise('MADV_DONTNEED', offset, len(chunk))
+                self._release(len(chunk))
+
+    def close(self):
+        with self.lock:
+            self.stopped.set()
+        # chunks left in the queues
+        self._release(self.reserved)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ResumableUpload:
+    """
+        Upload one local file through a resumable session.
+
+        http is any httplib2.Http-compatible object (request(uri, method, body, headers) -> (response, content)),
+        normally authorized by GoogleAuth. upload_url can point to a local fake endpoint for testing.
+        With file_id the content of that existing Drive file is replaced instead of creating a new file.
+        Subclasses uploading something else than a file pass file_path=None, the total size is then unknown.
+        A chunk that fails with a retryable error is sent again from the offset the server acknowledged.
+        bandwidth_limiter (a gdrive_ratelimit.TokenBucket) limits the bytes per second of this upload,
+        memory_budget (a gdrive_memory.MemoryBudget) the chunk buffers in flight.
+        The time of the upload phases (upload init, transfer, finalize) is added to stats (a gdrive_stats.Stats).
+    """
+
+    def __init__(self, http, file_path: str, metadata: dict, chunk_size=DEFAULT_CHUNK_SIZE,
+                 upload_url=UPLOAD_URL, session_store=None, file_id='', retry_policy=None, bandwidth_limiter=None,
+                 memory_budget=None, stats=None):
+        if chunk_size <= 0 or chunk_size % CHUNK_ALIGNMENT:
+            raise ValueError(f"Chunk size must be a positive multiple of {CHUNK_ALIGNMENT} bytes")
+        self.http = http
+        self.file_path = file_path
+        self.metadata = dict(metadata)
+        if file_path is not None:
+            self.metadata.setdefault('title', os.path.basename(file_path))
+        if not self.metadata.get('mimeType'):
+            self.metadata['mimeType'] = mimetypes.guess_type(file_path or self.metadata['title'])[0] \
+                or 'application/octet-stream'
+        self.chunk_size = chunk_size
+        self.upload_url = upload_url
+        self.file_id = file_id
+        self.session_store = session_store if session_store is not None else SessionStore()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.bandwidth_limiter = bandwidth_limiter
+        self.memory_budget = memory_budget
+        self.stats = stats or Stats()
+        self.total_size = os.path.getsize(file_path) if file_path is not None else None
+        self.session_uri = None
+        # MD5 of the uploaded file, known after upload() unless a session was resumed
+        self.md5 = None
+
+    def start(self):
+        """ Open a new upload session and return its URI """
+
+        headers = {
+            'Content-Type': 'application/json; charset=UTF-8',
+            'X-Upload-Content-Type': self.metadata['mimeType'],
+        }
+        if self.total_size is not None:
+            headers['X-Upload-Content-Length'] = str(self.total_size)
+        if self.file_id:
+            uri, method = f"{self.upload_url}/{self.file_id}", 'PUT'
+        else:
+            uri, method = self.upload_url, 'POST'
+        uri += "?uploadType=resumable&supportsTeamDrives=true"
+        response, content = self.http.request(uri, method, body=json.dumps(self.metadata), headers=headers)
+        if response.status != 200 or 'location' not in response:
+            raise ResumableUploadError(f"Cannot start upload session: HTTP {response.status}", response.status,
+                                       content, response)
+        return response['location']
+
+    def query_offset(self):
+        """
+            Ask the server how many bytes of the current session it has.
+            Returns (offset, None) while incomplete, (total_size, file resource) if the upload already finished
+            and (None, None) if the session no longer exists.
+        """
+
+        total = self.total_size if self.total_size is not None else '*'
+        headers = {'Content-Range': f"bytes */{total}", 'Content-Length': '0'}
+        response, content = self.http.request(self.session_uri, 'PUT', body=b'', headers=headers)
+        if response.status == 308:
+            return parse_range_offset(response), None
+        if response.status in (200, 201):
+            return self.total_size, json.loads(content)
+        if response.status in (404, 410):
+            return None, None
+        raise ResumableUploadError(f"Cannot query upload session: HTTP {response.status}", response.status, content,
+                                   response)
+
+    def send_chunk(self, offset: int, chunk, last=False):
+        """
+            Send a chunk starting at offset. Returns (next offset, file resource or None).
+            When the total size is unknown (streams), last marks the final chunk.
+        """
+
+        if self.total_size is not None:
+            total = self.total_size
+        else:
+            total = offset + len(chunk) if last else '*'
+        if len(chunk):
+            content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{total}"
+        else:
+            # empty file, or a stream ending exactly at a chunk boundary
+            content_range = f"bytes */{total}"
+        headers = {'Content-Range': content_range, 'Content-Length': str(len(chunk))}
+        response, content = self.http.request(self.session_uri, 'PUT', body=chunk, headers=headers)
+        if response.status == 308:
+            return parse_range_offset(response), None
+        if response.status in (200, 201):
+            return offset + len(chunk), json.loads(content)
+        raise ResumableUploadError(f"Chunk upload failed at byte {offset}: HTTP {response.status}", response.status,
+                                   content, response)
+
+    def send_chunk_timed(self, offset: int, chunk, last=False):
+        """ send_chunk_with_retry(), timed as transfer, or as finalize when it completes the upload """
+
+        started = time.perf_counter()
+        offset, resource = self.send_chunk_with_retry(offset, chunk, last)
+        self.stats.add('transfer' if resource is None else 'finalize', time.perf_counter() - started)
+        return offset, resource
+
+    def resume_or_start(self, key):
+        """ Reuse a persisted session if the server still knows it, otherwise open a new one """
+
+        session = self.session_store.load(key)
+        if session:
+            self.session_uri = session['uri']
+            offset, resource = self.retry_policy.call(self.query_offset)
+            if offset is not None:
+                print(f"Resuming upload from byte {offset} of {self.total_size}")
+                return offset, resource
+        self.session_uri = self.retry_policy.call(self.start)
+        self.session_store.save(key, {'uri': self.session_uri, 'file': os.path.abspath(self.file_path)})
+        return 0, None
+
+    def send_chunk_with_retry(self, offset: int, chunk, last=False):
+        """ send_chunk(), on retryable errors ask for the acknowledged offset and send the rest of the chunk """
+
+        chunk_offset = offset
+        attempt = 1
+        while True:
+            if self.bandwidth_limiter:
+                self.bandwidth_limiter.acquire(chunk_offset + len(chunk) - offset)
+            try:
+                return self.send_chunk(offset, chunk[offset - chunk_offset:], last)
+            except Exception as err:
+                if not self.retry_policy.should_retry(err, attempt):
+                    raise
+                self.retry_policy.wait(err, attempt)
+                attempt += 1
+                acknowledged, resource = self.retry_policy.call(self.query_offset)
+                if resource is not None:
+                    return acknowledged, resource
+                if acknowledged is None:
+                    raise ResumableUploadError("Upload session expired") from err
+                if not chunk_offset <= acknowledged <= chunk_offset + len(chunk):
+                    raise ResumableUploadError(f"Server acknowledged byte {acknowledged} outside of the current "
+                                               f"chunk {chunk_offset}-{chunk_offset + len(chunk)}") from err
+                offset = acknowledged
+
+    def upload(self):
+        """ Upload the whole file and return the created (or updated) file resource """
+
+        key = session_key(self.file_path, dict(self.metadata, id=self.file_id))
+        with self.stats.phase('upload init'):
+            offset, resource = self.resume_or_start(key)
+        if resource is None:
+            # a resumed upload reads the file from the chunk Drive stopped in, and is not checked against the MD5
+            with ChunkPipeline(self.file_path, self.chunk_size, memory_budget=self.memory_budget,
+                               start=offset) as pipeline:
+                for chunk_offset, chunk in pipeline:
+                    # the server may acknowledge only a part of a chunk, send the rest again
+                    while resource is None and (offset < chunk_offset + len(chunk) or not chunk):
+                        offset, resource = self.send_chunk_timed(offset, chunk[offset - chunk_offset:])
+                        if not chunk:
+                            break
+            if resource is None:
+                raise ResumableUploadError(f"Upload session not finalized after {offset} bytes")
+            self.md5 = pipeline.md5
+        self.session_store.delete(key)
+        if self.md5 and resource.get('md5Checksum') and resource['md5Checksum'] != self.md5:
+            raise ResumableUploadError(f"Uploaded {self.file_path} is corrupted: MD5 {resource['md5Checksum']} "
+                                       f"on Google Drive, {self.md5} locally")
+        return resource
+
+
+class StreamUpload(ResumableUpload):
+    """
+        Upload a binary stream of unknown length (e.g. stdin) through a resumable session.
+        At most one chunk is held in memory. A stream cannot be read again, so the session is not persisted.
+    """
+
+    def __init__(self, http, stream, metadata: dict, chunk_size=DEFAULT_CHUNK_SIZE, upload_url=UPLOAD_URL,
+                 file_id='', retry_policy=None, bandwidth_limiter=None, memory_budget=None, stats=None):
+        if not metadata.get('title'):
+            raise ValueError("Uploading a stream requires a title")
+        super().__init__(http, None, metadata, chunk_size, upload_url, file_id=file_id, retry_policy=retry_policy,
+                         bandwidth_limiter=bandwidth_limiter, memory_budget=memory_budget, stats=stats)
+        self.stream = stream
+
+    def upload(self):
+        """ Upload the stream until EOF and return the created (or updated) file resource """
+
+        with self.stats.phase('upload init'):
+            self.session_uri = self.retry_policy.call(self.start)
+        offset = 0
+        resource = None
+        while resource is None:
+            if self.memory_budget:
+                self.memory_budget.acquire(self.chunk_size)
+            try:
+                # read() of a buffered binary stream returns less than chunk_size only at EOF
+                chunk = self.stream.read(self.chunk_size)
+                last = len(chunk) < self.chunk_size
+                chunk_offset = offset
+                # the server may acknowledge only a part of the chunk, send the rest again
+                while resource is None and (offset < chunk_offset + len(chunk) or last):
+                    offset, resource = self.send_chunk_timed(offset, chunk[offset - chunk_offset:], last)
+                    if last and resource is None and offset == chunk_offset + len(chunk):
+                        raise ResumableUploadError(f"Upload session not finalized after {offset} bytes")
+            finally:
+                chunk = None
+                if self.memory_budget:
+                    self.memory_budget.release(self.chunk_size)
+        return resource
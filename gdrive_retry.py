@@ -0,0 +1,121 @@
+"""
+Retry policy for Google Drive requests: exponential backoff with jitter, honoring Retry-After.
+
+Retried are connection errors, HTTP 429 and 5xx, and 403 responses whose reason is a rate limit
+(rateLimitExceeded, userRateLimitExceeded).
+See https://developers.google.com/drive/api/v2/handle-errors#exponential-backoff
+"""
+
+import json
+import random
+import socket
+import threading
+import time
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+CONNECTION_ERRORS = (ConnectionError, TimeoutError, socket.timeout)
+
+
+def unwrap_error(err):
+    """ PyDrive wraps googleapiclient's HttpError into ApiRequestError, return the HttpError """
+
+    if err.args and hasattr(err.args[0], 'resp'):
+        return err.args[0]
+    return err
+
+
+def error_status(err):
+    """ HTTP status of a failed request or None """
+
+    err = unwrap_error(err)
+    if getattr(err, 'resp', None) is not None:
+        return err.resp.status
+    return getattr(err, 'status', None)
+
+
+def error_reason(err):
+    """ First reason from a Google API JSON error body, e.g. 'userRateLimitExceeded' """
+
+    content = getattr(unwrap_error(err), 'content', None)
+    if not content:
+        return None
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return json.loads(content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def error_retry_after(err):
+    """ Seconds from the Retry-After header of the failed response, if any """
+
+    err = unwrap_error(err)
+    response = getattr(err, 'resp', None) or getattr(err, 'response', None)
+    if not response:
+        return None
+    try:
+        return float(response.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(err):
+    """ Whether the request that raised err may succeed if repeated """
+
+    # http.client is slow to import and needed only once requests are made
+    import http.client
+
+    if isinstance(err, CONNECTION_ERRORS + (http.client.HTTPException,)):
+        return True
+    status = error_status(err)
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and error_reason(err) in RATE_LIMIT_REASONS
+
+
+class RetryPolicy:
+    """ Up to max_attempts tries of a request, sleeping base_delay * 2^n (with full jitter) between them """
+
+    def __init__(self, max_attempts=6, base_delay=1.0, max_delay=64.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        # number of retries done with this policy
+        self.retries = 0
+
+    def should_retry(self, err, attempt: int):
+        """ Whether to try again after attempt (counting from 1) failed with err """
+
+        return attempt < self.max_attempts and is_retryable(err)
+
+    def delay(self, err, attempt: int):
+        """ Seconds to wait before the next attempt, counted as a retry """
+
+        delay = error_retry_after(err)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        with self.lock:
+            self.retries += 1
+        print(f"Request failed ({err}), retrying in {delay:.1f}s (attempt {attempt + 1} of {self.max_attempts})")
+        return delay
+
+    def wait(self, err, attempt: int):
+        """ Sleep before the next attempt """
+
+        time.sleep(self.delay(err, attempt))
+
+    def call(self, func, *args, **kwargs):
+        """ Call func, repeating it on retryable errors """
+
+        attempt = 1
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                if not self.should_retry(err, attempt):
+                    raise
+                self.wait(err, attempt)
+                attempt += 1
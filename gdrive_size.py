@@ -0,0 +1,19 @@
+"""
+Sizes given on the command line (--chunk-size 8M). Standard library only, so gdrive_submit.py can use it.
+"""
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value: str) -> int:
+    """ Parse a size like 8388608, 256K, 8M or 1G into bytes """
+
+    value = value.strip().upper().rstrip('B')
+    multiplier = 1
+    if value and value[-1] in SIZE_SUFFIXES:
+        multiplier = SIZE_SUFFIXES[value[-1]]
+        value = value[:-1]
+    try:
+        return int(float(value) * multiplier)
+    except ValueError:
+        raise ValueError(f"Invalid size: {value}")
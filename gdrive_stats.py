@@ -0,0 +1,224 @@
+"""
+Run statistics (gdrive_upload.py --stats and --stats-json).
+
+Stats sums the time spent in each phase of a run (auth, folder resolution, hashing, upload init, transfer, finalize),
+counts uploaded files and bytes, and, through CountingHttp wrapped around every http object, Drive requests by API
+method. Phases of parallel uploads overlap, so their times are summed over all threads and may exceed the wall time.
+Request latencies and upload durations are also kept as histograms for the Prometheus metrics (gdrive_metrics).
+"""
+
+import contextlib
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+PHASES = ['auth', 'folder resolution', 'hash', 'upload init', 'transfer', 'finalize']
+# upper bounds in seconds of the histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+UPLOAD_BUCKETS = [1, 5, 15, 60, 300, 900, 3600, 4 * 3600]
+
+
+def phase_order(phase: str):
+    return PHASES.index(phase) if phase in PHASES else len(PHASES)
+
+
+def request_method(uri: str, method: str):
+    """ Drive API method of a request, e.g. files.list, upload or batch """
+
+    path = urllib.parse.urlsplit(uri).path
+    if '/upload/' in path:
+        return 'upload'
+    if path.startswith('/batch'):
+        return 'batch'
+    if '/discovery/' in path:
+        return 'discovery'
+    if '/token' in path:
+        return 'token'
+    if '/files' in path:
+        with_id = re.search(r'/files/[^/]+', path) is not None
+        methods = {('GET', False): 'files.list', ('POST', False): 'files.insert', ('GET', True): 'files.get',
+                   ('PUT', True): 'files.update', ('PATCH', True): 'files.patch', ('DELETE', True): 'files.delete'}
+        return methods.get((method, with_id), 'files')
+    return 'other'
+
+
+def body_size(body, headers=None):
+    """ Size in bytes of an HTTP request body, taken from its Content-Length header when there is one """
+
+    for name, value in (headers or {}).items():
+        if name.lower() == 'content-length':
+            return int(value)
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        return memoryview(body).nbytes
+    except TypeError:
+        # a stream without Content-Length, e.g. googleapiclient's _StreamSlice, has no known size
+        return 0
+
+
+class Histogram:
+    """ Histogram with cumulative bucket counts, the way Prometheus exposes them """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Stats:
+    """ Thread-safe statistics of one run. With json_file, every upload is appended to it as a JSON line """
+
+    def __init__(self, json_file=None):
+        self.json_file = json_file
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        # phase -> [count, seconds]
+        self.phases = {}
+        # API method -> {'count', 'seconds', 'errors', 'throttled', 'bytes'}
+        self.requests = {}
+        # API method -> Histogram of request seconds
+        self.latency = {}
+        self.upload_seconds = Histogram(UPLOAD_BUCKETS)
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        # uploads waiting for a thread or daemon slot, and uploads running
+        self.queued = 0
+        self.in_flight = 0
+
+    def add(self, phase: str, seconds: float):
+        with self.lock:
+            totals = self.phases.setdefault(phase, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, phase: str):
+        """ Time the block as phase """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def record_request(self, method: str, seconds: float, status=None, size=0):
+        """ One HTTP request, status None if it failed without a response """
+
+        with self.lock:
+            totals = self.requests.setdefault(method, {'count': 0, 'seconds': 0.0, 'errors': 0, 'throttled': 0,
+                                                       'bytes': 0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += size
+            if status is None or status >= 400:
+                totals['errors'] += 1
+            if status == 429:
+                totals['throttled'] += 1
+            self.latency.setdefault(method, Histogram(LATENCY_BUCKETS)).observe(seconds)
+
+    def add_queued(self, count: int):
+        with self.lock:
+            self.queued += count
+
+    @contextlib.contextmanager
+    def uploading(self):
+        """ Count the block as an upload in flight, and as failed if it raises """
+
+        with self.lock:
+            self.in_flight += 1
+        try:
+            yield
+        except BaseException:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def record_upload(self, name: str, resource, started: float):
+        """ Count a finished upload started at started (perf_counter), return resource """
+
+        seconds = time.perf_counter() - started
+        size = int(resource.get('fileSize') or 0)
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            self.upload_seconds.observe(seconds)
+            if self.json_file:
+                self._write({'event': 'upload', 'file': name, 'id': resource.get('id'), 'bytes': size,
+                             'seconds': round(seconds, 6), 'bytes_per_second': round(size / seconds if seconds else 0)})
+        return resource
+
+    def _write(self, record: dict):
+        with open(self.json_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def summary(self, retries=0):
+        """ Statistics of the run so far as a dict """
+
+        seconds = time.perf_counter() - self.started
+        with self.lock:
+            phases = {phase: {'count': count, 'seconds': round(total, 6)}
+                      for phase, (count, total) in sorted(self.phases.items(), key=lambda item: phase_order(item[0]))}
+            requests = {method: dict(totals, seconds=round(totals['seconds'], 6))
+                        for method, totals in sorted(self.requests.items())}
+            transfer = self.phases.get('transfer', [0, 0.0])[1]
+            return {'event': 'summary', 'seconds': round(seconds, 6), 'files': self.files, 'failed': self.failed,
+                    'bytes': self.bytes,
+                    'bytes_per_second': round(self.bytes / seconds if seconds else 0),
+                    # rate of a single upload while it is sending
+                    'transfer_bytes_per_second': round(self.bytes / transfer if transfer else 0),
+                    'phases': phases, 'requests': requests,
+                    'request_count': sum(totals['count'] for totals in requests.values()), 'retries': retries}
+
+    def report(self, retries=0):
+        """ Print the summary, append it to json_file """
+
+        summary = self.summary(retries)
+        print("Stats:")
+        for phase, totals in summary['phases'].items():
+            print(f"    {phase:<20} {totals['count']:>6} x {totals['seconds']:>10.3f}s")
+        print(f"    Uploaded {summary['files']} files, {summary['bytes'] / 1024 ** 2:.1f} MiB in "
+              f"{summary['seconds']:.1f}s ({summary['bytes_per_second'] / 1024 ** 2:.2f} MiB/s)")
+        requests = ', '.join(f"{method} {totals['count']}" for method, totals in summary['requests'].items())
+        print(f"    Requests: {summary['request_count']} ({requests or 'not counted'}), retries: {retries}")
+        if self.json_file:
+            with self.lock:
+                self._write(summary)
+
+
+class CountingHttp:
+    """ httplib2.Http-compatible wrapper recording every request in stats """
+
+    def __init__(self, http, stats: Stats):
+        self.http = http
+        self.stats = stats
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        start = time.perf_counter()
+        status = None
+        try:
+            response, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+            status = response.status
+            return response, content
+        finally:
+            self.stats.record_request(request_method(uri, method), time.perf_counter() - start, status,
+                                      body_size(body, headers))
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
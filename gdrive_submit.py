@@ -0,0 +1,87 @@
+"""
+Submit upload jobs to a running upload daemon (python gdrive_upload.py --serve SOCKET_FILE).
+
+Usage: python gdrive_submit.py --socket SOCKET_FILE --file FILE_TO_UPLOAD [FILE_TO_UPLOAD ...]
+    (optional) --name UPLOADED_FILE_NAME --directory-name GDRIVE_FOLDER_NAME --directory-id GDRIVE_FOLDER_ID
+    --chunk-size CHUNK_SIZE --skip-existing
+
+Only the standard library and gdrive_size (itself standard library only) are imported, so a submission costs
+little more than the upload itself.
+Exits with status 1 if any of the files failed to upload.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import socket
+import sys
+
+from gdrive_size import parse_size
+
+
+def parse_args():
+    """ Parse arguments """
+
+    parser = ArgumentParser(description="Submit upload jobs to gdrive_upload.py --serve")
+    parser.add_argument('-S', '--socket', type=str, help='Unix socket of the upload daemon', required=True)
+    parser.add_argument('-f', '--file', type=str, nargs='+', help='Files to upload', required=True)
+    parser.add_argument('-n', '--name', type=str, help='Destination name in Google Drive(optional)', required=False)
+    parser.add_argument('-dn', '--directory-name', type=str,
+                        help='Folder name(in gdrive root dir) to upload in (optional)', required=False)
+    parser.add_argument('-di', '--directory-id', type=str, help='Folder id to upload in (optional)', required=False)
+    parser.add_argument('-cs', '--chunk-size', type=parse_size,
+                        help='Use resumable upload with chunks of this size, e.g. 8M (optional)', required=False)
+    parser.add_argument('--skip-existing', action='store_true',
+                        help='Skip files already uploaded with the same name and content (optional)')
+
+    args = parser.parse_args()
+
+    if args.name and len(args.file) > 1:
+        raise Exception("--name can only be used when uploading a single file")
+    return args
+
+
+def submit(socket_file: str, jobs: list):
+    """ Send all jobs to the daemon, which runs up to its --jobs of them at a time, and yield (job, result) """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_file)
+        with sock.makefile('rwb') as stream:
+            for index, job in enumerate(jobs):
+                # results come back in the order the uploads finish, tagged with the job index
+                stream.write((json.dumps(dict(job, job=index)) + '\n').encode())
+            stream.flush()
+            for _ in jobs:
+                line = stream.readline()
+                if not line:
+                    raise Exception("Upload daemon closed the connection")
+                result = json.loads(line)
+                yield jobs[result['job']], result
+
+
+def main():
+    """ Main """
+
+    args = parse_args()
+    jobs = []
+    for file_to_upload in args.file:
+        # the daemon may run in another working directory
+        job = {'file': os.path.abspath(file_to_upload)}
+        for key in ('name', 'directory_name', 'directory_id', 'chunk_size', 'skip_existing'):
+            if getattr(args, key):
+                job[key] = getattr(args, key)
+        jobs.append(job)
+
+    failed = 0
+    for job, result in submit(args.socket, jobs):
+        if result['ok']:
+            print(f"Uploaded {job['file']}: {result['id']}")
+        else:
+            print(f"Failed to upload {job['file']}: {result['error']}")
+            failed += 1
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Local manifest for incremental sync (gdrive_upload.py --sync).
+
+The manifest remembers, for every file of the synced tree, its size, mtime, MD5 and the ID of its Drive copy.
+A file whose size and mtime did not change since the last run is neither hashed nor uploaded again.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from gdrive_cache import CACHE_DIR, write_json_atomic
+
+MANIFEST_DIR = os.path.join(CACHE_DIR, 'manifests')
+MANIFEST_VERSION = 1
+# Save progress of long syncs every SAVE_INTERVAL seconds, so an interrupted run does not redo everything
+SAVE_INTERVAL = 60
+
+
+def default_manifest_path(local_dir: str, parent_folder_id: str, account: str):
+    """ Manifest file for syncing local_dir into parent_folder_id with account """
+
+    key = json.dumps([os.path.abspath(local_dir), parent_folder_id, account])
+    return os.path.join(MANIFEST_DIR, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+
+class Manifest:
+    """ Relative path -> {'size', 'mtime_ns', 'md5', 'id'}, stored as JSON """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.saved_at = time.time()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.files = data['files']
+        except (OSError, ValueError):
+            pass
+
+    def get(self, relative_path: str):
+        return self.files.get(relative_path)
+
+    @staticmethod
+    def is_unchanged(entry, stat):
+        """ Whether a file with this os.stat() result is the one recorded in entry """
+
+        return entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+
+    def set(self, relative_path: str, stat, md5: str, file_id: str):
+        with self.lock:
+            self.files[relative_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': md5,
+                                         'id': file_id}
+            if time.time() - self.saved_at > SAVE_INTERVAL:
+                self._save()
+
+    def retain(self, relative_paths):
+        """ Forget files that are no longer in the local tree """
+
+        with self.lock:
+            self.files = {path: entry for path, entry in self.files.items() if path in relative_paths}
+
+    def _save(self):
+        write_json_atomic(self.path, {'version': MANIFEST_VERSION, 'files': self.files})
+        self.saved_at = time.time()
+
+    def save(self):
+        with self.lock:
+            self._save()
@@ -0,0 +1,136 @@
+"""
+Access token management.
+
+oauth2client refreshes an access token only after a request fails with 401, so an upload running when the
+hour-long token lapses loses a request (or a whole chunk). TokenManager refreshes the token shortly before it expires,
+in a background thread. All http objects authorized with the same credentials pick up the new token.
+
+ServiceAccountTokenCache keeps service account access tokens on disk, so frequent runs reuse a token instead of
+signing a JWT and calling the token endpoint every time.
+"""
+
+import calendar
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+from gdrive_cache import CACHE_DIR, write_json_atomic, write_text_atomic
+
+TOKEN_CACHE_DIR = os.path.join(CACHE_DIR, 'tokens')
+
+# Refresh again after this many seconds if a refresh failed
+RETRY_INTERVAL = 30
+# Seconds at least between two refreshes, even if the new token expires within the margin
+MIN_REFRESH_INTERVAL = 10
+# Google access tokens are valid for an hour, a margin must leave some of it
+MAX_REFRESH_MARGIN = 50 * 60
+
+
+def save_credentials_atomic(credentials, credentials_file: str):
+    """ Save credentials in the format of GoogleAuth.SaveCredentialsFile, replacing the file atomically """
+
+    write_text_atomic(credentials_file, credentials.to_json(), mode=0o600)
+
+
+class ServiceAccountTokenCache:
+    """
+        Access tokens of service account credentials, one file (readable by the owner only) per key ID and scopes.
+        A cached token is used while it is valid for at least margin more seconds.
+    """
+
+    def __init__(self, directory=TOKEN_CACHE_DIR, margin=300):
+        self.directory = directory
+        self.margin = margin
+
+    def _path(self, credentials):
+        key = json.dumps([getattr(credentials, '_service_account_email', None),
+                          getattr(credentials, '_private_key_id', None),
+                          sorted(str(getattr(credentials, '_scopes', '')).split())])
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+    def load(self, credentials):
+        """ Put a cached, still valid access token into credentials. Returns whether there was one """
+
+        try:
+            with open(self._path(credentials)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        expiry = datetime.datetime.utcfromtimestamp(cached['token_expiry'])
+        if (expiry - datetime.datetime.utcnow()).total_seconds() < self.margin:
+            return False
+        credentials.access_token = cached['access_token']
+        credentials.token_expiry = expiry
+        return True
+
+    def save(self, credentials):
+        if not credentials.access_token or credentials.token_expiry is None:
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        write_json_atomic(self._path(credentials),
+                          {'access_token': credentials.access_token,
+                           'token_expiry': calendar.timegm(credentials.token_expiry.utctimetuple())}, mode=0o600)
+
+
+class TokenManager(threading.Thread):
+    """
+        Refresh credentials margin seconds before their access token expires.
+        If credentials_file is given, every refreshed token is written back to it, if token_cache is given
+        (service accounts), to the cache.
+    """
+
+    def __init__(self, credentials, credentials_file=None, margin=300, token_cache=None):
+        super().__init__(name='token-manager', daemon=True)
+        self.credentials = credentials
+        self.credentials_file = credentials_file
+        self.token_cache = token_cache
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def seconds_left(self):
+        """ Seconds until the access token expires, None if the expiry is unknown """
+
+        expiry = self.credentials.token_expiry
+        if expiry is None:
+            return None
+        return (expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def refresh(self):
+        import httplib2
+
+        with self.lock:
+            self.credentials.refresh(httplib2.Http())
+            if self.credentials_file:
+                save_credentials_atomic(self.credentials, self.credentials_file)
+            if self.token_cache:
+                self.token_cache.save(self.credentials)
+        print(f"Access token refreshed, valid for {self.seconds_left():.0f}s")
+
+    def run(self):
+        refreshed = False
+        while not self.stopped.is_set():
+            seconds_left = self.seconds_left()
+            if seconds_left is None and self.credentials.access_token:
+                # nothing to schedule on, e.g. credentials without expiry
+                return
+            # service account credentials have no token until the first refresh
+            wait = seconds_left - self.margin if seconds_left is not None else 0
+            if refreshed:
+                # a token expiring within the margin would otherwise be refreshed in a busy loop
+                wait = max(wait, MIN_REFRESH_INTERVAL)
+                refreshed = False
+            if wait > 0:
+                self.stopped.wait(wait)
+                continue
+            try:
+                self.refresh()
+                refreshed = True
+            except Exception as err:
+                print(f"Cannot refresh access token: {err}")
+                self.stopped.wait(RETRY_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
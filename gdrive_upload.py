@@ -2,8 +2,16 @@
 Authenticate and upload files on Google Drive with PyDrive.
 
 Usage:
-    python gdrive_upload.py (--credentials CREDENTIALS_FILE OR --service-account-key SERVICE_ACCOUNT_KEY_FILE --file FILE_TO_UPLOAD
+    python gdrive_upload.py (--credentials CREDENTIALS_FILE OR --service-account-key SERVICE_ACCOUNT_KEY_FILE
+        (--file FILE_TO_UPLOAD [FILE_OR_GLOB ...] OR --recursive LOCAL_DIRECTORY OR --sync LOCAL_DIRECTORY
+         OR --serve SOCKET_FILE)
         (optional) --name UPLOADED_FILE_NAME --directory-name GDRIVE_FOLDER_NAME --directory-id GDRIVE_FOLDER_ID
+        --chunk-size CHUNK_SIZE --jobs PARALLEL_UPLOADS --folder-cache-ttl SECONDS --skip-existing
+        --manifest SYNC_MANIFEST_FILE --retries RETRIES --retry-delay SECONDS
+        --max-requests-per-second RATE --max-bytes-per-second RATE --rate-limit-file FILE --engine {pydrive,async}
+        --max-bandwidth RATE --bandwidth-window HH:MM-HH:MM=RATE [--bandwidth-window ...] --compress {gzip,zstd}
+        --max-memory SIZE --stats --stats-json STATS_FILE --metrics-file METRICS_FILE --metrics-port PORT
+        --token-refresh-margin SECONDS --no-token-cache
 
 Expected workflow is:
     - Using service account key:
@@ -24,16 +32,152 @@ Expected workflow is:
         
         3. Run this script with --credentials argument
 
+    - Large files:
+        Use --chunk-size (e.g. 8M, a multiple of 256K) to upload through a resumable session. The session is saved
+        under ~/.cache/gdrive_upload/sessions, so rerunning the same command after a failure continues from the last
+        byte Google Drive has received. The file is memory-mapped, the next chunks are read and hashed while the
+        current one is sent, and the upload is checked against the MD5 computed by Google Drive (a resumed upload
+        reads only the rest of the file and is not checked). Memory use stays small however big the file is.
+
+    - Many files:
+        Pass several paths or globs to --file (quote globs to let the script expand them) and --jobs N to upload
+        them over N threads with one authorization.
+
+    - Directory trees:
+        --recursive DIR recreates DIR with all its subfolders inside the destination folder (renamed with --name)
+        and uploads its files, --jobs at a time. Folders that already exist are reused.
+
+    - Frequent runs:
+        The folder ID found for --directory-name is cached in ~/.cache/gdrive_upload/folders.json for
+        --folder-cache-ttl seconds (1 hour by default, 0 disables the cache). If Drive reports the cached folder as
+        missing, the entry is dropped, the folder is looked up again and the upload is repeated.
+
+    - Repeated uploads:
+        With --skip-existing a file is skipped if a file with the same name and MD5 is already in the destination
+        folder (up to 20 files are looked up by name, more list the folder once). A same-named file with other
+        content is updated in place instead of uploading a duplicate.
+
+    - Incremental sync:
+        --sync DIR works like --recursive but keeps a manifest (size, mtime, MD5 and Drive file ID of every file,
+        in ~/.cache/gdrive_upload/manifests or --manifest). Next runs only stat the tree: unchanged files are
+        skipped without hashing and changed files replace their Drive copy by ID. Files deleted locally are not
+        deleted from Google Drive.
+
+    - Pipes:
+        --file - reads the content from stdin and streams it to Google Drive in --chunk-size chunks
+        (8M by default) without a temporary file. --name is required, e.g.
+            pg_dump mydb | gzip | python gdrive_upload.py -s key.json -di FOLDER_ID --file - --name mydb.sql.gz
+
+    - Errors:
+        Requests failed with 429, 5xx, a rate limit 403 or a connection error are retried --retries times with
+        exponential backoff and jitter (or after Retry-After). In resumable uploads only the failed chunk is resent.
+        Without --chunk-size a file is sent through a resumable session in 8M chunks, so a retry never creates
+        the file twice; with --retries 0 it is a single PyDrive call.
+
+    - Quotas:
+        --max-requests-per-second and --max-bytes-per-second spread requests evenly to stay under Drive per-user
+        quotas. Processes started with the same --rate-limit-file share these limits.
+
+    - Shared links:
+        --max-bandwidth limits every single upload (each of --jobs) to RATE bytes per second; files are then sent in
+        chunks of at most one second of traffic, so the rate stays smooth. --bandwidth-window changes the total
+        --max-bytes-per-second limit during a time of day (local time, may cross midnight, 0 is unlimited), e.g.
+        throttle office hours and run at full speed at night:
+            --bandwidth-window 08:00-18:00=2M --bandwidth-window 18:00-08:00=0
+
+    - Small machines:
+        Chunked uploads hold a few chunks per upload in memory (the file itself is memory-mapped), so memory depends
+        on --chunk-size and --jobs, not on file sizes. --max-memory SIZE (at least one chunk) caps the chunk
+        buffers of all uploads together, uploads wait for memory instead of exceeding it; files are then always
+        sent in chunks. The peak memory use (RSS) is printed at the end of every run.
+
+    - Finding where the time goes:
+        --stats prints at the end of a run the time spent per phase (auth, folder resolution, hash, upload init,
+        transfer, finalize; summed over parallel uploads), files, bytes and bytes/sec, and Drive requests per API
+        method and retries. --stats-json FILE appends every upload and the final summary to FILE as JSON lines.
+        With --retries 0 and without --chunk-size an upload is a single PyDrive call, counted as transfer.
+
+    - Monitoring:
+        --metrics-file FILE writes Prometheus metrics (uploads, failures, bytes, request latency histograms by API
+        method, 429s, retries, time per phase) to FILE when the run ends, for node_exporter's textfile collector,
+        e.g. --metrics-file /var/lib/node_exporter/textfile/gdrive_upload.prom. --metrics-port PORT serves the
+        same metrics, with uploads in flight and queued, on http://127.0.0.1:PORT/metrics while the run or the
+        --serve daemon is running.
+
+    - Compressible files:
+        --compress gzip (or zstd, multi-threaded, pip install zstandard) compresses files while they are uploaded
+        and adds .gz (.zst) to their Drive names. Logs and CSVs usually shrink 5-10 times, and so does the upload.
+        Works with stdin too: --file - --name app.log --compress zstd uploads app.log.zst.
+
+    - Thousands of small files:
+        --engine async uploads --file files with asyncio over one pooled aiohttp session (pip install aiohttp),
+        keeping --jobs uploads in flight on a single thread, e.g. --engine async --jobs 200.
+
+    - Long runs:
+        The access token is refreshed in the background --token-refresh-margin seconds before it expires, so
+        uploads never stall on an expired token. With --credentials the refreshed token is saved back to the file.
+        Service account tokens are cached in ~/.cache/gdrive_upload/tokens (owner-only files) and reused by the
+        next runs until they are about to expire (--no-token-cache disables this).
+        The Drive API discovery document is cached in ~/.cache/gdrive_upload/discovery instead of being downloaded
+        by every run.
+
+    - Upload daemon:
+        --serve SOCKET_FILE authorizes once and then waits for upload jobs on a Unix socket, running up to --jobs
+        of them at a time. Submit jobs with gdrive_submit.py, which starts instantly:
+            python gdrive_upload.py -s key.json --serve /tmp/gdrive_upload.sock --jobs 8 &
+            python gdrive_submit.py --socket /tmp/gdrive_upload.sock --file report.csv --directory-id FOLDER_ID
+        Every job is one JSON line: {"file": ..., "name": ..., "directory_id": ..., "directory_name": ...,
+        "chunk_size": ..., "skip_existing": ..., "job": ...}, answered with {"ok": true, "id": ..., "job": ...} or
+        {"ok": false, "error": ..., "job": ...}. The jobs of one connection run in parallel and are answered as
+        they finish, "job" (any value, e.g. an index) tells which job an answer belongs to.
+
 """
 
-from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
-from pydrive.files import GoogleDriveFileList
-import googleapiclient.errors
-from oauth2client.service_account import ServiceAccountCredentials
+# PyDrive, googleapiclient, oauth2client and asyncio are imported where they are used: --help, argument errors
+# and gdrive_submit.py should not pay for them
+
+from gdrive_batch import MetadataBatch
+from gdrive_cache import FolderCache, DEFAULT_FOLDER_CACHE_TTL, load_discovery_document
+from gdrive_compress import CompressedStream, SUFFIXES, MIME_TYPES
+from gdrive_memory import MemoryBudget, peak_rss
+from gdrive_ratelimit import BandwidthSchedule, ThrottledHttp, TokenBucket, make_bucket, parse_bandwidth_window
+from gdrive_retry import RetryPolicy, error_status
+from gdrive_stats import CountingHttp, Stats
+from gdrive_resumable import ResumableUpload, StreamUpload, CHUNK_ALIGNMENT, DEFAULT_CHUNK_SIZE
+from gdrive_query import FOLDER_MIME_TYPE, files_query, folder_query
+from gdrive_size import parse_size
+from gdrive_sync import Manifest, default_manifest_path
+from gdrive_token import ServiceAccountTokenCache, TokenManager, MAX_REFRESH_MARGIN, save_credentials_atomic
 
 from argparse import ArgumentParser
-import ast
+from stat import S_ISSOCK
+import atexit
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+HASH_BLOCK_SIZE = 1024 * 1024
+# --skip-existing looks up to this many files by title, one query each, and lists the whole folder for more
+TITLE_LOOKUP_MAX_FILES = 20
+# --file value for reading the content from stdin
+STDIN = '-'
+
+# Used for every Drive request, configured by --retries and --retry-delay
+retry_policy = RetryPolicy()
+# Token buckets for --max-requests-per-second and --max-bytes-per-second, None when not limited
+request_limiter = None
+bytes_limiter = None
+# Phase times, uploads and requests of this run (--stats, --stats-json)
+stats = Stats()
+# authorized http objects of the current thread, by id of their GoogleAuth
+thread_local = threading.local()
 
 
 def parse_args():
@@ -44,116 +188,1026 @@ def parse_args():
                         help='Credentials file for GoogleAuth().LoadCredentialsFile. Use gdrive_get_credentials.py')
     parser.add_argument('-s', '--service-account-key', type=str,
                         help='Service account JSON key file for GoogleAuth()')
-    parser.add_argument('-f', '--file', type=str, help='File to upload', required=True)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-f', '--file', type=str, nargs='+', help='Files or glob patterns to upload, - for stdin')
+    source.add_argument('-r', '--recursive', type=str, metavar='DIR',
+                        help='Local directory to upload with all its subdirectories')
+    source.add_argument('--sync', type=str, metavar='DIR',
+                        help='Local directory to upload like --recursive, skipping files unchanged since last sync')
+    source.add_argument('--serve', type=str, metavar='SOCKET_FILE',
+                        help='Run as a daemon accepting upload jobs on this Unix socket (see gdrive_submit.py)')
     parser.add_argument('-n', '--name', type=str, help='Destination name in Google Drive(optional)', required=False)
     parser.add_argument('-dn', '--directory-name', type=str,
                         help='Folder name(in gdrive root dir) to upload in (optional)', required=False)
     parser.add_argument('-di', '--directory-id', type=str, help='Folder id to upload in (optional)', required=False)
+    parser.add_argument('-cs', '--chunk-size', type=parse_size, default=0,
+                        help='Use resumable upload with chunks of this size, e.g. 8M (optional)', required=False)
+    parser.add_argument('--folder-cache-ttl', type=int, default=DEFAULT_FOLDER_CACHE_TTL,
+                        help='Seconds to reuse the cached --directory-name folder ID, 0 to disable (optional)',
+                        required=False)
+    parser.add_argument('--skip-existing', action='store_true',
+                        help='Skip files already uploaded with the same name and content, update same-named files '
+                             'with different content (optional)')
+    parser.add_argument('--manifest', type=str, help='Manifest file for --sync (optional)', required=False)
+    parser.add_argument('--retries', type=int, default=retry_policy.max_attempts - 1,
+                        help='How many times to retry a request failed with 429, 5xx or rate limit error (optional)',
+                        required=False)
+    parser.add_argument('--retry-delay', type=float, default=retry_policy.base_delay,
+                        help='Initial delay in seconds between retries, doubled on every retry (optional)',
+                        required=False)
+    parser.add_argument('--max-requests-per-second', type=float, default=0,
+                        help='Limit the rate of Drive requests (optional)', required=False)
+    parser.add_argument('--max-bytes-per-second', type=parse_size, default=0,
+                        help='Limit the rate of uploaded bytes, e.g. 10M (optional)', required=False)
+    parser.add_argument('--rate-limit-file', type=str,
+                        help='Share request and byte rate limits with other processes using this file (optional)',
+                        required=False)
+    parser.add_argument('--max-bandwidth', type=parse_size, default=0,
+                        help='Limit the rate of every single upload, e.g. 1M (optional)', required=False)
+    parser.add_argument('--bandwidth-window', type=parse_bandwidth_window, action='append', default=[],
+                        help='Total byte rate limit during a time of day, e.g. 08:00-18:00=2M, 0 for unlimited; '
+                             'repeatable (optional)', required=False)
+    parser.add_argument('--compress', type=str, choices=sorted(SUFFIXES), default='',
+                        help='Compress files while uploading and add .gz or .zst to their names (optional)',
+                        required=False)
+    parser.add_argument('--max-memory', type=parse_size, default=0,
+                        help='Limit the memory of chunk buffers of all uploads together, e.g. 256M (optional)',
+                        required=False)
+    parser.add_argument('--stats', action='store_true',
+                        help='Print time per phase, throughput, request and retry counts at the end (optional)')
+    parser.add_argument('--stats-json', type=str,
+                        help='Append every upload and the final stats to this file as JSON lines (optional)',
+                        required=False)
+    parser.add_argument('--metrics-file', type=str,
+                        help='Write Prometheus metrics to this file at the end, for the textfile collector (optional)',
+                        required=False)
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics while running (optional)',
+                        required=False)
+    parser.add_argument('--engine', type=str, choices=['pydrive', 'async'], default='pydrive',
+                        help='Upload --file files with PyDrive threads or with asyncio and aiohttp (optional)',
+                        required=False)
+    parser.add_argument('--token-refresh-margin', type=int, default=300,
+                        help='Refresh the access token this many seconds before it expires (optional)',
+                        required=False)
+    parser.add_argument('--no-token-cache', action='store_true',
+                        help='Do not reuse service account access tokens cached by previous runs (optional)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel uploads (optional)',
+                        required=False)
 
     args = parser.parse_args()
 
     if not args.credentials and not args.service_account_key:
         raise Exception("Specify at least one way to authorize(--credentials or --service-account-key")
+    if args.chunk_size % CHUNK_ALIGNMENT:
+        raise Exception(f"--chunk-size must be a multiple of {CHUNK_ALIGNMENT} bytes(256K)")
+    if args.jobs < 1:
+        raise Exception("--jobs must be at least 1")
+    if args.serve and (args.name or args.directory_id or args.directory_name or args.skip_existing):
+        raise Exception("--serve takes --name, --directory-id, --directory-name and --skip-existing per job, "
+                        "pass them to gdrive_submit.py")
+    if args.engine == 'async' and (not args.file or args.file == [STDIN] or args.skip_existing or args.max_bandwidth
+                                   or args.compress or args.max_memory or args.stats or args.stats_json
+                                   or args.metrics_file or args.metrics_port):
+        raise Exception("--engine async supports only --file files, without --skip-existing, --max-bandwidth, "
+                        "--compress, --max-memory, --stats and metrics")
+    if not 0 <= args.token_refresh_margin <= MAX_REFRESH_MARGIN:
+        raise Exception(f"--token-refresh-margin must be between 0 and {MAX_REFRESH_MARGIN} seconds")
+    if args.max_memory and args.max_memory < (args.chunk_size or DEFAULT_CHUNK_SIZE):
+        raise Exception("--max-memory must be at least --chunk-size (8M by default)")
+    if args.compress and args.skip_existing:
+        raise Exception("--skip-existing cannot be used with --compress, the uploaded content differs")
+    for local_dir in (args.recursive, args.sync):
+        if local_dir and not os.path.isdir(local_dir):
+            raise Exception(f"Cannot find directory {local_dir}")
     return args
 
 
+def authorize(gauth):
+    """
+        Same as GoogleAuth.Authorize(), but builds the Drive service from the cached discovery document
+        instead of downloading it on every run
+    """
+
+    from googleapiclient.discovery import build_from_document
+
+    if gauth.access_token_expired:
+        raise Exception("No valid credentials provided to authorize")
+    gauth.http = gauth.Get_Http_Object()
+    gauth.service = build_from_document(load_discovery_document(gauth.http), http=gauth.http)
+
+
 def auth_with_credentials(credentials_file='credentials.json'):
     """ Authentication using credentials_file. Use gdrive_get_credentials.py """
 
+    from pydrive.auth import GoogleAuth
+
     gauth = GoogleAuth()
 
     gauth.LoadCredentialsFile(credentials_file)
     # print(f"gauth.credentials: {gauth.credentials}, \ngauth.access_token_expired: {gauth.access_token_expired}")
     if gauth.credentials is None:
         raise Exception(f"Error while loading {credentials_file}")
-    elif gauth.access_token_expired:
+    # oauth2client would rewrite the file in place on every refresh, save_credentials_atomic() is the only writer
+    gauth.credentials.set_store(None)
+    if gauth.access_token_expired:
         print("Token expired. Refreshing token")
         gauth.Refresh()
+        save_credentials_atomic(gauth.credentials, credentials_file)
     else:
         print("Authorizing using current token")
-        gauth.Authorize()
+    authorize(gauth)
     print("Successfully authorized")
 
     return gauth
 
 
-def auth_with_service_account_key(service_account_key):
+def auth_with_service_account_key(service_account_key, token_cache=None):
     """
         Authentication using service account key(JSON) (https://cloud.google.com/endpoints/docs/openapi/service-account-authentication)
+        With token_cache (ServiceAccountTokenCache) a cached access token is reused and a new one is saved to it.
     """
 
+    from pydrive.auth import GoogleAuth
+    from oauth2client.service_account import ServiceAccountCredentials
+
     gauth = GoogleAuth()
     scope = ["https://www.googleapis.com/auth/drive"]
     gauth.credentials = ServiceAccountCredentials.from_json_keyfile_name(service_account_key, scope)
-    gauth.Authorize()
+    if token_cache:
+        if token_cache.load(gauth.credentials):
+            print("Authorizing using cached token")
+        else:
+            # would happen on the first request anyway, do it now to cache the token
+            gauth.credentials.get_access_token()
+            token_cache.save(gauth.credentials)
+    authorize(gauth)
 
     return gauth
 
 
+def iterate_pages(drive, param: dict):
+    """
+        Pages of files.list(**param), each a list of file resources, fetched with retries.
+        Shared drives are searched too, like the batch and async lookups do.
+    """
+
+    # GoogleDriveFileList of PyDrive 1.3.1 opens a new connection for every page, so list with the
+    # thread's http object instead
+    http = get_http(drive)
+    page_token = None
+    while True:
+        request = get_service(drive).files().list(pageToken=page_token, supportsTeamDrives=True,
+                                                  includeTeamDriveItems=True, **param)
+        # a failed page request is sent again as is, with the same page token
+        response = retry_policy.call(lambda: request.execute(http=http))
+        yield response.get('items', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+
+
 def get_folder_id_by_name(drive, parent_folder_id: str, folder_name: str):
     """ Check if destination folder exists and if so return it's ID """
 
-    # Auto-iterate through all files in the parent folder.
-    file_list = GoogleDriveFileList()
+    # Let Drive filter by title and type and send back only the fields we need, instead of listing
+    # every child of the parent folder
+    param = {'q': folder_query(parent_folder_id, folder_name), 'fields': 'items(id,title),nextPageToken',
+             'maxResults': 100}
     try:
-        file_list = drive.ListFile( {'q': "'{0}' in parents and trashed=false".format(parent_folder_id)} ).GetList()
-    # Exit if the parent folder doesn't exist
-    except googleapiclient.errors.HttpError as err:
-        # Parse error message
-        message = ast.literal_eval(err.content)['error']['message']
-        if message == 'File not found: ':
-            print(message + folder_name)
-            exit(1)
-        # Exit with stacktrace in case of other error
-        else:
-            raise
+        # Pages are fetched one at a time, so stop at the first page with a match
+        for page in iterate_pages(drive, param):
+            for file1 in page:
+                if file1['title'] == folder_name:
+                    print('title: %s, id: %s' % (file1['title'], file1['id']))
+                    return file1['id']
+    except Exception as err:
+        if error_status(err) == 404:
+            print(f"File not found: {parent_folder_id}")
+        raise
+
+
+def create_folder(drive, parent_folder_id: str, folder_name: str):
+    """ Create folder and return it's ID """
+
+    attempt = 1
+    while True:
+        folder = drive.CreateFile({'title': folder_name, 'mimeType': FOLDER_MIME_TYPE,
+                                   'parents': [{"kind": "drive#fileLink", "id": parent_folder_id}]})
+        try:
+            # a plain insert is sent once, repeating it could create the folder twice
+            folder.Upload(param={'supportsTeamDrives': True, 'http': get_http(drive)})
+            break
+        except Exception as err:
+            if not retry_policy.should_retry(err, attempt):
+                raise
+            retry_policy.wait(err, attempt)
+            attempt += 1
+        # the failed creation may have been applied: create again only if the folder is still missing
+        folder_id = get_folder_id_by_name(drive, parent_folder_id, folder_name)
+        if folder_id:
+            return folder_id
+    print('Created folder title: %s, id: %s' % (folder_name, folder['id']))
+    return folder['id']
+
+
+def list_folder_files(drive, parent_folder_id: str, title=''):
+    """
+        Return {title: [{'id', 'title', 'md5Checksum'}, ...]} for the files (not folders) in the folder.
+        With title only the files titled so are listed, filtered by Drive.
+    """
+
+    param = {'q': files_query(parent_folder_id, title), 'fields': 'items(id,title,md5Checksum),nextPageToken',
+             'maxResults': 1000}
+    files = {}
+    for page in iterate_pages(drive, param):
+        for file1 in page:
+            files.setdefault(file1['title'], []).append(file1)
+    return files
+
+
+def file_md5(file_path: str):
+    """ MD5 hex digest of a file, read block by block """
+
+    md5 = hashlib.md5()
+    with stats.phase('hash'), open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class FolderTree:
+    """
+        Drive folders mirroring a local directory tree.
+        Every folder is looked up (and created if missing) at most once, even when requested from several threads.
+    """
+
+    def __init__(self, drive, root_folder_id: str):
+        self.drive = drive
+        # local path relative to the tree root -> Drive folder ID
+        self.folder_ids = {'': root_folder_id}
+        # folders created by this run are known to be empty
+        self.created = set()
+        self.folder_files = {}
+        self.lock = threading.Lock()
+        self.path_locks = {}
+
+    def get_folder_id(self, relative_dir: str):
+        """ Return ID of the Drive folder for relative_dir, creating it and its parents when needed """
+
+        if relative_dir in self.folder_ids:
+            return self.folder_ids[relative_dir]
+        with self.lock:
+            path_lock = self.path_locks.setdefault(relative_dir, threading.Lock())
+        with path_lock:
+            if relative_dir not in self.folder_ids:
+                parent_dir, folder_name = os.path.split(relative_dir)
+                parent_folder_id = self.get_folder_id(parent_dir)
+                folder_id = get_folder_id_by_name(self.drive, parent_folder_id, folder_name)
+                if not folder_id:
+                    folder_id = create_folder(self.drive, parent_folder_id, folder_name)
+                    self.created.add(relative_dir)
+                self.folder_ids[relative_dir] = folder_id
+        return self.folder_ids[relative_dir]
+
+    def get_folder_files(self, relative_dir: str):
+        """ list_folder_files() of the folder for relative_dir, listed once per run """
+
+        folder_id = self.get_folder_id(relative_dir)
+        with self.lock:
+            path_lock = self.path_locks.setdefault(relative_dir, threading.Lock())
+        with path_lock:
+            if relative_dir not in self.folder_files:
+                if relative_dir in self.created:
+                    self.folder_files[relative_dir] = {}
+                else:
+                    self.folder_files[relative_dir] = list_folder_files(self.drive, folder_id)
+        return self.folder_files[relative_dir]
+
+    def create_all(self, relative_dirs):
+        """
+            Look up and create the folders for relative_dirs and their parents ahead of the uploads,
+            one depth level at a time, with one batch of lookups and one batch of creations per level.
+        """
+
+        pending = set()
+        for relative_dir in relative_dirs:
+            while relative_dir not in self.folder_ids and relative_dir not in pending:
+                pending.add(relative_dir)
+                relative_dir = os.path.dirname(relative_dir)
+        if not pending:
+            return
+        service = get_service(self.drive)
+        http = get_http(self.drive)
+
+        for depth in sorted({relative_dir.count(os.sep) for relative_dir in pending}):
+            level = sorted(relative_dir for relative_dir in pending if relative_dir.count(os.sep) == depth)
+            # nothing to look up in a folder created by this run
+            missing = [relative_dir for relative_dir in level if os.path.dirname(relative_dir) in self.created]
+            missing += self._look_up(service, http, [relative_dir for relative_dir in level
+                                                     if relative_dir not in missing])
+            attempt = 1
+            while missing:
+                failed = self._create(service, http, missing)
+                if not failed:
+                    break
+                err = failed[0][1]
+                if not retry_policy.should_retry(err, attempt):
+                    raise err
+                retry_policy.wait(err, attempt)
+                attempt += 1
+                # a failed creation may have been applied: create again only the folders still missing
+                missing = self._look_up(service, http, [relative_dir for relative_dir, _ in failed])
+
+    def _look_up(self, service, http, relative_dirs):
+        """ Look up the folders for relative_dirs in one batch, return those that do not exist """
+
+        lookups = MetadataBatch(service, http, retry_policy)
+        for relative_dir in relative_dirs:
+            parent_dir, folder_name = os.path.split(relative_dir)
+            query = folder_query(self.folder_ids[parent_dir], folder_name)
+            lookups.add(service.files().list(q=query, fields='items(id,title)', maxResults=10,
+                                             supportsTeamDrives=True, includeTeamDriveItems=True), relative_dir)
+        missing = []
+        for relative_dir, result in lookups.execute().items():
+            if isinstance(result, Exception):
+                raise result
+            folder_name = os.path.basename(relative_dir)
+            folder_ids = [item['id'] for item in result.get('items', []) if item['title'] == folder_name]
+            if folder_ids:
+                self.folder_ids[relative_dir] = folder_ids[0]
+            else:
+                missing.append(relative_dir)
+        return missing
+
+    def _create(self, service, http, relative_dirs):
+        """ Create the folders for relative_dirs in one batch, sent once. Return (relative_dir, error) of failed """
+
+        creations = MetadataBatch(service, http, retry_policy, idempotent=False)
+        for relative_dir in relative_dirs:
+            parent_dir, folder_name = os.path.split(relative_dir)
+            body = {'title': folder_name, 'mimeType': FOLDER_MIME_TYPE,
+                    'parents': [{"kind": "drive#fileLink", "id": self.folder_ids[parent_dir]}]}
+            creations.add(service.files().insert(body=body, fields='id', supportsTeamDrives=True), relative_dir)
+        failed = []
+        for relative_dir, result in creations.execute().items():
+            if isinstance(result, Exception):
+                failed.append((relative_dir, result))
+                continue
+            print('Created folder title: %s, id: %s' % (os.path.basename(relative_dir), result['id']))
+            self.folder_ids[relative_dir] = result['id']
+            self.created.add(relative_dir)
+        return failed
+
+
+def expand_files(patterns):
+    """ Expand glob patterns into a list of files, keeping the given order and dropping duplicates """
+
+    files = []
+    seen = set()
+    for pattern in patterns:
+        if pattern == STDIN:
+            if len(patterns) > 1:
+                raise Exception("stdin(-) cannot be uploaded together with other files")
+            return [STDIN]
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise Exception(f"No files match {pattern}")
+        for path in matches:
+            if not os.path.isfile(path):
+                raise Exception(f"Cannot find file {path}")
+            if path not in seen:
+                seen.add(path)
+                files.append(path)
+    return files
+
+
+def get_service(drive):
+    """ googleapiclient Drive v2 service of drive, as used by PyDrive """
+
+    if drive.auth.service is None:
+        authorize(drive.auth)
+    return drive.auth.service
+
+
+def get_http(drive):
+    """ Authorized httplib2.Http of drive for the current thread """
+
+    # httplib2.Http is not thread-safe, so every worker thread keeps its own
+    if not hasattr(thread_local, 'http'):
+        thread_local.http = {}
+    key = id(drive.auth)
+    if key not in thread_local.http:
+        thread_local.http[key] = drive.auth.Get_Http_Object()
+    return thread_local.http[key]
 
-    # Find the destination folder in the parent folder's files
-    for file1 in file_list:
-        if file1['title'] == folder_name:
-            print('title: %s, id: %s' % (file1['title'], file1['id']))
-            return file1['id']
 
+def configure_stats(gauth):
+    """ Count the requests of every http object PyDrive creates for gauth in stats """
 
-def upload(drive, file_to_upload: str, parent_folder_id='', uploaded_file_name=''):
-    """ Upload file """
+    get_http_object = gauth.Get_Http_Object
+    gauth.Get_Http_Object = lambda: CountingHttp(get_http_object(), stats)
 
-    upload_args = {}
-    if uploaded_file_name:
-        upload_args["title"] = uploaded_file_name
+
+def configure_rate_limits(gauth, max_requests_per_second=0, max_bytes_per_second=0, rate_limit_file=None,
+                          bandwidth_windows=()):
+    """
+        Apply request and byte rate limits to every http object PyDrive creates for gauth.
+        bandwidth_windows ((start minute, end minute, rate) tuples) replace max_bytes_per_second during their time.
+    """
+
+    global request_limiter, bytes_limiter
+    schedule = BandwidthSchedule(max_bytes_per_second, bandwidth_windows) if bandwidth_windows else None
+    request_limiter = make_bucket(max_requests_per_second, rate_limit_file, 'requests')
+    bytes_limiter = make_bucket(max_bytes_per_second, rate_limit_file, 'bytes', schedule)
+    if request_limiter or bytes_limiter:
+        # PyDrive creates the per-thread http objects with Get_Http_Object()
+        get_http_object = gauth.Get_Http_Object
+        gauth.Get_Http_Object = lambda: ThrottledHttp(get_http_object(), request_limiter, bytes_limiter)
+
+
+def bandwidth_chunk_size(chunk_size: int, bandwidth: int):
+    """ Largest chunk size up to chunk_size sent in about a second at bandwidth bytes per second """
+
+    return max(CHUNK_ALIGNMENT, min(chunk_size, bandwidth // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT))
+
+
+class UploadOptions:
+    """
+        How files are sent, the same for every upload of a run:
+        max_bandwidth bytes per second of every single upload (--max-bandwidth), 0 when not limited,
+        compression the --compress method, '' to upload files as they are,
+        memory_budget a gdrive_memory.MemoryBudget for the chunk buffers of all uploads (--max-memory), or None.
+    """
+
+    def __init__(self, max_bandwidth=0, compression='', memory_budget=None):
+        self.max_bandwidth = max_bandwidth
+        self.compression = compression
+        self.memory_budget = memory_budget
+
+
+def upload(drive, file_to_upload: str, parent_folder_id='', uploaded_file_name='', chunk_size=0, file_id='',
+           options=None):
+    """
+        Upload file. With chunk_size the file is sent through a resumable upload session.
+        With file_id the content of that existing Drive file is replaced.
+        options is an UploadOptions:
+        with max_bandwidth set the file is always sent in chunks, each upload limited on its own,
+        with compression set the file is compressed while it is sent and the suffix is added to its name,
+        with memory_budget set the file is always sent in chunks, taken from the budget.
+    """
+
+    options = options or UploadOptions()
+    started = time.perf_counter()
+    if file_to_upload == STDIN and not uploaded_file_name:
+        raise Exception("Specify --name for the content read from stdin")
+    # PyDrive would otherwise name the file after the path as given, directories included
+    metadata = {"title": uploaded_file_name or os.path.basename(file_to_upload)}
     if parent_folder_id:
-        upload_args["parents"] = [{"kind": "drive#fileLink","id": parent_folder_id}]
+        metadata["parents"] = [{"kind": "drive#fileLink","id": parent_folder_id}]
+
+    if options.memory_budget:
+        # PyDrive reads 100 MB requests outside of the budget
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    bandwidth_limiter = None
+    if options.max_bandwidth:
+        # a PyDrive upload is one request that cannot be paced, send chunks instead
+        chunk_size = bandwidth_chunk_size(chunk_size or DEFAULT_CHUNK_SIZE, options.max_bandwidth)
+        bandwidth_limiter = TokenBucket(options.max_bandwidth)
+    if file_to_upload == STDIN or options.compression:
+        # the length of a stream is not known in advance, it is sent chunk by chunk
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    elif not chunk_size and retry_policy.max_attempts == 1:
+        file = drive.CreateFile(dict(metadata, id=file_id) if file_id else metadata)
+        file.SetContentFile(file_to_upload)
+        print(f"Uploading file {file_to_upload}")
+        # one PyDrive call from the start of the session to the uploaded file, not retried
+        with stats.phase('transfer'):
+            file.Upload(param={'supportsTeamDrives': True, 'http': get_http(drive)})
+        return stats.record_upload(file_to_upload, file, started)
+
+    source_name = 'stdin' if file_to_upload == STDIN else f"file {file_to_upload}"
+    if options.compression:
+        metadata["title"] += SUFFIXES[options.compression]
+        metadata["mimeType"] = MIME_TYPES[options.compression]
+        print(f"Uploading {options.compression} compressed {source_name} as {metadata['title']}")
+    elif chunk_size:
+        print(f"Uploading {source_name} in {chunk_size} byte chunks")
+    else:
+        # PyDrive would repeat the whole insert on a retry, and create the file twice if the failed request was
+        # applied nevertheless. A resumable session asks Drive what it has instead. Its chunks are as small as
+        # with --chunk-size: the pipeline keeps a few of them in memory
+        print(f"Uploading {source_name}")
+        chunk_size = DEFAULT_CHUNK_SIZE
+
+    upload_args = dict(file_id=file_id, retry_policy=retry_policy, bandwidth_limiter=bandwidth_limiter,
+                       memory_budget=options.memory_budget, stats=stats)
+    with contextlib.ExitStack() as stack:
+        stream = None
+        if file_to_upload == STDIN:
+            stream = sys.stdin.buffer
+        elif options.compression:
+            stream = stack.enter_context(open(file_to_upload, 'rb'))
+        if options.compression:
+            stream = stack.enter_context(CompressedStream(stream, options.compression))
+        if stream is None:
+            uploaded = ResumableUpload(get_http(drive), file_to_upload, metadata, chunk_size, **upload_args).upload()
+        else:
+            uploaded = StreamUpload(get_http(drive), stream, metadata, chunk_size, **upload_args).upload()
+    return stats.record_upload(file_to_upload, uploaded, started)
+
+
+def upload_if_changed(drive, existing_files: dict, file_to_upload: str, parent_folder_id='', uploaded_file_name='',
+                      chunk_size=0, md5='', options=None):
+    """
+        Upload file unless existing_files (see list_folder_files()) has a file with the same title and MD5.
+        If only the title matches, the existing file is updated in place.
+    """
+
+    title = uploaded_file_name or os.path.basename(file_to_upload)
+    same_title = existing_files.get(title)
+    if not same_title:
+        return upload(drive, file_to_upload, parent_folder_id, uploaded_file_name, chunk_size, options=options)
+
+    md5 = md5 or file_md5(file_to_upload)
+    for existing in same_title:
+        if existing.get('md5Checksum') == md5:
+            print(f"Skipping {file_to_upload}, identical file already exists: {existing['id']}")
+            return existing
+    print(f"Updating existing file {same_title[0]['id']}")
+    return upload(drive, file_to_upload, parent_folder_id, uploaded_file_name, chunk_size, same_title[0]['id'],
+                  options)
+
+
+def upload_if_changed_by_title(drive, file_to_upload: str, parent_folder_id='', uploaded_file_name='', chunk_size=0,
+                               options=None):
+    """ upload_if_changed() against the same-named files of the folder, looked up by title """
+
+    title = uploaded_file_name or os.path.basename(file_to_upload)
+    existing_files = list_folder_files(drive, parent_folder_id or 'root', title)
+    return upload_if_changed(drive, existing_files, file_to_upload, parent_folder_id, uploaded_file_name, chunk_size,
+                             options=options)
+
+
+class ParallelUploadError(Exception):
+    """ Some of the parallel tasks failed. errors maps task name to its exception """
+
+    def __init__(self, errors: dict, total: int):
+        super().__init__(f"{len(errors)} of {total} uploads failed")
+        self.errors = errors
+        self.total = total
+
+
+def run_parallel(tasks, jobs=1):
+    """ Run (name, function, *args) tasks over a pool of jobs threads. Raise if any of them failed """
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    def run_task(function, *args):
+        stats.add_queued(-1)
+        with stats.uploading():
+            return function(*args)
+
+    errors = {}
+    stats.add_queued(len(tasks))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_task, *task[1:]): task[0] for task in tasks}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                print(f"Failed to upload {futures[future]}: {err}")
+                errors[futures[future]] = err
+    if errors:
+        raise ParallelUploadError(errors, len(futures))
+
+
+def upload_files(drive, files, parent_folder_id='', uploaded_file_name='', chunk_size=0, jobs=1,
+                 skip_existing=False, options=None):
+    """ Upload files over a pool of jobs threads sharing one authorized drive """
+
+    if skip_existing and len(files) <= TITLE_LOOKUP_MAX_FILES:
+        tasks = [(file_to_upload, upload_if_changed_by_title, drive, file_to_upload, parent_folder_id,
+                  uploaded_file_name, chunk_size, options) for file_to_upload in files]
+    elif skip_existing:
+        existing_files = list_folder_files(drive, parent_folder_id or 'root')
+        tasks = [(file_to_upload, upload_if_changed, drive, existing_files, file_to_upload, parent_folder_id,
+                  uploaded_file_name, chunk_size, '', options) for file_to_upload in files]
+    else:
+        tasks = [(file_to_upload, upload, drive, file_to_upload, parent_folder_id, uploaded_file_name, chunk_size,
+                  '', options) for file_to_upload in files]
+    run_parallel(tasks, jobs)
+
+
+def upload_files_with_asyncio(drive, files, parent_folder_id='', uploaded_file_name='', chunk_size=0, jobs=1,
+                              parent_folder_name='', folder_found=None):
+    """
+        Upload files with the asyncio engine, jobs uploads in flight, using drive's credentials.
+        parent_folder_name is looked up by the engine itself, see gdrive_async.upload_files_async().
+    """
+
+    import asyncio
+    from gdrive_async import upload_files_async
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(upload_files_async(
+            drive.auth.credentials, files, parent_folder_id, uploaded_file_name, chunk_size or DEFAULT_CHUNK_SIZE,
+            jobs, retry_policy, request_limiter, bytes_limiter, parent_folder_name, folder_found))
+    finally:
+        loop.close()
+    errors = {file_to_upload: result for file_to_upload, result in results.items() if isinstance(result, Exception)}
+    for file_to_upload, err in errors.items():
+        print(f"Failed to upload {file_to_upload}: {err}")
+    if errors:
+        raise ParallelUploadError(errors, len(files))
+
+
+def upload_tree_file(drive, tree: FolderTree, file_to_upload: str, relative_dir: str, chunk_size=0,
+                     skip_existing=False, options=None):
+    """ Upload one file of a local tree into its mirrored folder """
+
+    folder_id = tree.get_folder_id(relative_dir)
+    if skip_existing:
+        upload_if_changed(drive, tree.get_folder_files(relative_dir), file_to_upload, folder_id, '', chunk_size,
+                          options=options)
+    else:
+        upload(drive, file_to_upload, folder_id, '', chunk_size, options=options)
+
+
+def upload_tree(drive, local_dir: str, parent_folder_id='', uploaded_dir_name='', chunk_size=0, jobs=1,
+                skip_existing=False, options=None):
+    """ Mirror local_dir (its folders and files) into parent_folder_id """
+
+    local_dir = os.path.abspath(local_dir)
+    root_name = uploaded_dir_name or os.path.basename(local_dir)
+    tree = FolderTree(drive, parent_folder_id or 'root')
+
+    tasks = []
+    relative_dirs = []
+    for dir_path, dir_names, file_names in os.walk(local_dir):
+        dir_names.sort()
+        relative_dir = os.path.normpath(os.path.join(root_name, os.path.relpath(dir_path, local_dir)))
+        relative_dirs.append(relative_dir)
+        for file_name in sorted(file_names):
+            file_to_upload = os.path.join(dir_path, file_name)
+            tasks.append((file_to_upload, upload_tree_file, drive, tree, file_to_upload, relative_dir, chunk_size,
+                          skip_existing, options))
+    # the whole folder hierarchy (empty folders too) in a few batch requests
+    with stats.phase('folder resolution'):
+        tree.create_all(relative_dirs)
+    run_parallel(tasks, jobs)
+
+
+def sync_file(drive, tree: FolderTree, manifest: Manifest, file_to_upload: str, relative_path: str, stat,
+              chunk_size=0, skip_existing=False, options=None):
+    """ Upload a new or modified file of a synced tree and record it in the manifest """
+
+    options = options or UploadOptions()
+    entry = manifest.get(relative_path)
+    md5 = ''
+    if entry or skip_existing:
+        md5 = file_md5(file_to_upload)
+    if entry and entry['md5'] == md5:
+        # only mtime changed
+        manifest.set(relative_path, stat, md5, entry['id'])
+        return
+
+    relative_dir = os.path.dirname(relative_path)
+    uploaded = None
+    if entry:
+        try:
+            uploaded = upload(drive, file_to_upload, chunk_size=chunk_size, file_id=entry['id'], options=options)
+        except Exception as err:
+            # Drive copy was deleted, upload the file again
+            if error_status(err) != 404:
+                raise
+    if uploaded is None:
+        folder_id = tree.get_folder_id(relative_dir)
+        if skip_existing:
+            uploaded = upload_if_changed(drive, tree.get_folder_files(relative_dir), file_to_upload, folder_id, '',
+                                         chunk_size, md5, options)
+        else:
+            uploaded = upload(drive, file_to_upload, folder_id, '', chunk_size, options=options)
+    if not md5:
+        # a new file is not read twice: Drive returns the MD5 of the uploaded content (unless it was compressed)
+        md5 = (not options.compression and uploaded.get('md5Checksum')) or file_md5(file_to_upload)
+    manifest.set(relative_path, stat, md5, uploaded['id'])
+
+
+def sync_tree(drive, local_dir: str, manifest_path: str, parent_folder_id='', uploaded_dir_name='', chunk_size=0,
+              jobs=1, skip_existing=False, options=None):
+    """ Mirror local_dir into parent_folder_id, uploading only files changed since the manifest was saved """
+
+    local_dir = os.path.abspath(local_dir)
+    root_name = uploaded_dir_name or os.path.basename(local_dir)
+    tree = FolderTree(drive, parent_folder_id or 'root')
+    manifest = Manifest(manifest_path)
+
+    tasks = []
+    relative_paths = set()
+    # folders of new files
+    new_dirs = set()
+    for dir_path, dir_names, file_names in os.walk(local_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_to_upload = os.path.join(dir_path, file_name)
+            relative_path = os.path.normpath(os.path.join(root_name, os.path.relpath(file_to_upload, local_dir)))
+            relative_paths.add(relative_path)
+            stat = os.stat(file_to_upload)
+            entry = manifest.get(relative_path)
+            if entry is None:
+                new_dirs.add(os.path.dirname(relative_path))
+            if not Manifest.is_unchanged(entry, stat):
+                tasks.append((file_to_upload, sync_file, drive, tree, manifest, file_to_upload, relative_path, stat,
+                              chunk_size, skip_existing, options))
+    manifest.retain(relative_paths)
+    print(f"{len(tasks)} of {len(relative_paths)} files changed since last sync")
+    with stats.phase('folder resolution'):
+        tree.create_all(new_dirs)
+    try:
+        run_parallel(tasks, jobs)
+    finally:
+        manifest.save()
+
+
+def is_parent_not_found(err):
+    """ Whether err means the destination folder is gone: every upload into it failed with 404 """
+
+    if isinstance(err, ParallelUploadError):
+        return len(err.errors) == err.total and all(error_status(error) == 404 for error in err.errors.values())
+    return error_status(err) == 404
+
 
-    file = drive.CreateFile(upload_args)
-    file.SetContentFile(file_to_upload)
-    print(f"Uploading file")
-    file.Upload(param={'supportsTeamDrives': True})
+def resolve_directory_name(drive, folder_cache: FolderCache, account: str, folder_name: str):
+    """ Return ID of folder_name in the drive root and whether it came from the cache """
+
+    folder_id = folder_cache.get(account, 'root', folder_name)
+    if folder_id:
+        print('title: %s, id: %s (cached)' % (folder_name, folder_id))
+        return folder_id, True
+    with stats.phase('folder resolution'):
+        folder_id = get_folder_id_by_name(drive, 'root', folder_name)
+    if not folder_id:
+        raise Exception(f"Cannot find parent directory {folder_name}")
+    folder_cache.set(account, 'root', folder_name, folder_id)
+    return folder_id, False
+
+
+def run_uploads(drive, args, files, parent_folder_id: str, folder_cache=None, options=None):
+    """
+        Upload --sync or --recursive directory or --file files into parent_folder_id, sent as options
+        (an UploadOptions) say. The async engine looks up --directory-name itself when parent_folder_id is empty.
+    """
+
+    account = os.path.abspath(args.credentials or args.service_account_key)
+    if args.sync:
+        manifest_path = args.manifest or default_manifest_path(args.sync, parent_folder_id, account)
+        sync_tree(drive, args.sync, manifest_path, parent_folder_id, args.name, args.chunk_size, args.jobs,
+                  args.skip_existing, options)
+    elif args.recursive:
+        upload_tree(drive, args.recursive, parent_folder_id, args.name, args.chunk_size, args.jobs,
+                    args.skip_existing, options)
+    elif args.engine == 'async':
+        folder_name = '' if parent_folder_id else args.directory_name or ''
+
+        def folder_found(folder_id):
+            if folder_cache is not None:
+                folder_cache.set(account, 'root', folder_name, folder_id)
+
+        upload_files_with_asyncio(drive, files, parent_folder_id, args.name, args.chunk_size, args.jobs,
+                                  folder_name, folder_found)
+    else:
+        upload_files(drive, files, parent_folder_id, args.name, args.chunk_size, args.jobs, args.skip_existing,
+                     options)
+
+
+class UploadRequestHandler(socketserver.StreamRequestHandler):
+    """
+        Read upload jobs, one JSON object per line, and answer each with one JSON line.
+        The jobs of a connection run in parallel, so answers come in the order the jobs finish;
+        the 'job' value of a job is copied to its answer to match them.
+    """
+
+    def handle(self):
+        from concurrent.futures import wait
+
+        self.write_lock = threading.Lock()
+        futures = []
+        for line in self.rfile:
+            futures.append(self.server.submit(self.handle_job, line))
+        # answer the running jobs before the connection is closed
+        wait(futures)
+
+    def handle_job(self, line: bytes):
+        job = {}
+        try:
+            job = json.loads(line)
+            uploaded = self.server.run_job(job)
+            result = {'ok': True, 'id': uploaded['id']}
+        except Exception as err:
+            print(f"Job failed: {err}")
+            result = {'ok': False, 'error': str(err)}
+        if isinstance(job, dict) and 'job' in job:
+            result['job'] = job['job']
+        with self.write_lock:
+            self.wfile.write((json.dumps(result) + '\n').encode())
+            self.wfile.flush()
+
+
+class UploadServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Upload daemon keeping one authorized drive for all jobs """
+
+    daemon_threads = True
+
+    def __init__(self, socket_file: str, drive, account: str, folder_cache: FolderCache, chunk_size=0, jobs=1,
+                 options=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        super().__init__(socket_file, UploadRequestHandler)
+        self.drive = drive
+        self.account = account
+        self.folder_cache = folder_cache
+        self.chunk_size = chunk_size
+        self.jobs = jobs
+        self.options = options
+        # every connection gets a thread, but the jobs of all connections share these workers, so only
+        # jobs uploads run at a time and the worker threads (and their http objects) are kept between connections
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def submit(self, function, *args):
+        """ Run function(*args) on a free worker, return its future """
+
+        stats.add_queued(1)
+
+        def run():
+            stats.add_queued(-1)
+            return function(*args)
+        return self.executor.submit(run)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+    def upload_job(self, job: dict, parent_folder_id: str):
+        chunk_size = job.get('chunk_size', self.chunk_size)
+        with stats.uploading():
+            if job.get('skip_existing'):
+                # only the same-named files matter, not every file of a possibly large folder
+                return upload_if_changed_by_title(self.drive, job['file'], parent_folder_id, job.get('name', ''),
+                                                  chunk_size, self.options)
+            return upload(self.drive, job['file'], parent_folder_id, job.get('name', ''), chunk_size,
+                          options=self.options)
+
+    def run_job(self, job: dict):
+        """ Upload job['file'] and return the uploaded file """
+
+        if not os.path.isfile(job.get('file', '')):
+            raise Exception(f"Cannot find file {job.get('file')}")
+        directory_name = job.get('directory_name')
+        if job.get('directory_id') or not directory_name:
+            return self.upload_job(job, job.get('directory_id', ''))
+
+        parent_folder_id, from_cache = resolve_directory_name(self.drive, self.folder_cache, self.account,
+                                                              directory_name)
+        try:
+            return self.upload_job(job, parent_folder_id)
+        except Exception as err:
+            if not from_cache or error_status(err) != 404:
+                raise
+            self.folder_cache.invalidate(self.account, 'root', directory_name)
+            parent_folder_id, _ = resolve_directory_name(self.drive, self.folder_cache, self.account,
+                                                         directory_name)
+            return self.upload_job(job, parent_folder_id)
+
+
+def serve(drive, socket_file: str, account: str, folder_cache: FolderCache, chunk_size=0, jobs=1, options=None):
+    """ Run the upload daemon on socket_file until interrupted """
+
+    if os.path.lexists(socket_file):
+        # connect() is refused by any file, never remove what is not a socket
+        if not S_ISSOCK(os.lstat(socket_file).st_mode):
+            raise Exception(f"{socket_file} exists and is not a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_file)
+            raise Exception(f"Another daemon is already listening on {socket_file}")
+        except ConnectionRefusedError:
+            # left by a daemon that is not running anymore
+            os.remove(socket_file)
+        finally:
+            probe.close()
+    # the socket is created readable and writable by the owner only, other users cannot connect in between
+    umask = os.umask(0o177)
+    try:
+        server = UploadServer(socket_file, drive, account, folder_cache, chunk_size, jobs, options)
+    finally:
+        os.umask(umask)
+    print(f"Waiting for upload jobs on {socket_file}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_file)
+
+
+def report_memory(memory_budget=None):
+    """ Print the peak memory use of the run, and of the chunk buffers taken from memory_budget """
+
+    peak = peak_rss()
+    if peak is not None:
+        print(f"Peak memory (RSS): {peak / 1024 ** 2:.1f} MiB")
+    if memory_budget:
+        print(f"Peak chunk buffers: {memory_budget.peak / 1024 ** 2:.1f} MiB "
+              f"of {memory_budget.limit / 1024 ** 2:.1f} MiB")
+
+
+def report_stats():
+    stats.report(retry_policy.retries)
+
+
+def write_metrics(metrics_file: str):
+    from gdrive_metrics import write_textfile
+
+    write_textfile(metrics_file, stats, retry_policy.retries)
 
 
 def main():
     """ Main """
 
     args = parse_args()
+    retry_policy.max_attempts = args.retries + 1
+    retry_policy.base_delay = args.retry_delay
+    files = expand_files(args.file) if args.file else []
+    if args.name and len(files) > 1:
+        raise Exception("--name can only be used when uploading a single file")
+    if files == [STDIN] and args.skip_existing:
+        raise Exception("--skip-existing cannot be used with stdin(-)")
+
+    stats.json_file = args.stats_json
+    if args.stats or args.stats_json:
+        atexit.register(report_stats)
+    if args.metrics_file:
+        atexit.register(write_metrics, args.metrics_file)
+    if args.metrics_port:
+        from gdrive_metrics import serve_metrics
+        serve_metrics(args.metrics_port, stats, lambda: retry_policy.retries)
 
     # auth
     gauth = ""
-    if args.credentials:
-        gauth = auth_with_credentials(args.credentials)
-    elif args.service_account_key:
-        gauth = auth_with_service_account_key(args.service_account_key)
-    else:
-        raise Exception("Actually we cannot get here, cause we are filtering this case on parse_args()")
+    token_cache = None
+    with stats.phase('auth'):
+        if args.credentials:
+            gauth = auth_with_credentials(args.credentials)
+        elif args.service_account_key:
+            token_cache = None if args.no_token_cache else ServiceAccountTokenCache(margin=args.token_refresh_margin)
+            gauth = auth_with_service_account_key(args.service_account_key, token_cache)
+        else:
+            raise Exception("Actually we cannot get here, cause we are filtering this case on parse_args()")
+
+    options = UploadOptions(args.max_bandwidth, args.compress,
+                            MemoryBudget(args.max_memory) if args.max_memory else None)
+    atexit.register(report_memory, options.memory_budget)
+    if args.stats or args.stats_json or args.metrics_file or args.metrics_port:
+        # inside the rate limits, so waiting for them does not count as request time
+        configure_stats(gauth)
+    configure_rate_limits(gauth, args.max_requests_per_second, args.max_bytes_per_second, args.rate_limit_file,
+                          args.bandwidth_window)
+    # Keep the token shared by all threads valid during long runs, refreshed tokens go back to --credentials
+    token_manager = TokenManager(gauth.credentials, args.credentials, args.token_refresh_margin, token_cache)
+    token_manager.start()
 
     # drive
+    from pydrive.drive import GoogleDrive
     drive = GoogleDrive(gauth)
     parent_folder_id = ''
+    from_cache = False
+    folder_cache = FolderCache(ttl=args.folder_cache_ttl)
+    account = os.path.abspath(args.credentials or args.service_account_key)
+    if args.serve:
+        serve(drive, args.serve, account, folder_cache, args.chunk_size, args.jobs, options)
+        return
     if args.directory_id:
         parent_folder_id = args.directory_id
+    elif args.directory_name and args.engine == 'async':
+        # unless cached, the async engine looks the folder up on its own connections
+        parent_folder_id = folder_cache.get(account, 'root', args.directory_name) or ''
+        from_cache = bool(parent_folder_id)
     elif args.directory_name:
-        parent_folder_id = get_folder_id_by_name(drive, 'root', args.directory_name)
-        if not parent_folder_id:
-            raise Exception(f"Cannot find parent directory {args.directory_name}")
-    upload(drive, args.file, parent_folder_id, args.name)
+        parent_folder_id, from_cache = resolve_directory_name(drive, folder_cache, account, args.directory_name)
+    try:
+        run_uploads(drive, args, files, parent_folder_id, folder_cache, options)
+    except Exception as err:
+        if not from_cache or not is_parent_not_found(err):
+            raise
+        print(f"Cached folder {args.directory_name} not found, looking it up again")
+        folder_cache.invalidate(account, 'root', args.directory_name)
+        parent_folder_id = ''
+        if args.engine != 'async':
+            parent_folder_id, _ = resolve_directory_name(drive, folder_cache, account, args.directory_name)
+        run_uploads(drive, args, files, parent_folder_id, folder_cache, options)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,897 @@
+"""
+Smoke tests of gdrive_upload.py against the local fake Google Drive (gdrive_fake_drive.py).
+
+The upload tests run the command line in a new interpreter, with GDRIVE_API_ROOT pointing to the fake and an unexpired
+access token, so PyDrive, googleapiclient and httplib2 from requirements.txt are exercised as in production.
+
+Usage:
+    python -m unittest test_gdrive_upload
+"""
+
+from gdrive_fake_drive import FakeDrive
+
+import datetime
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import urllib.parse
+import urllib.request
+
+UPLOAD_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gdrive_upload.py')
+SUBMIT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gdrive_submit.py')
+
+
+def write_credentials(path: str):
+    """ Credentials file with an access token valid for a day, accepted by the fake """
+
+    from oauth2client.client import OAuth2Credentials
+
+    expiry = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    credentials = OAuth2Credentials('test-token', 'test-client', 'test-secret', 'test-refresh', expiry,
+                                    'http://127.0.0.1:1/token', 'test_gdrive_upload')
+    with open(path, 'w') as f:
+        f.write(credentials.to_json())
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeDrive(seed=0)
+        self.root_url = self.fake.start()
+        self.work_dir = tempfile.mkdtemp(prefix='test_gdrive_upload_')
+        self.credentials = os.path.join(self.work_dir, 'credentials.json')
+        write_credentials(self.credentials)
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.work_dir)
+
+    def write_file(self, name: str, content: bytes):
+        path = os.path.join(self.work_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def upload_command(self, *args):
+        return [sys.executable, UPLOAD_SCRIPT, '-c', self.credentials, '--retry-delay', '0.01'] + list(args)
+
+    def env(self):
+        return dict(os.environ, GDRIVE_API_ROOT=self.root_url, XDG_CACHE_HOME=os.path.join(self.work_dir, 'cache'))
+
+    def run_upload(self, *args, stdin=None, succeed=True):
+        """ Run gdrive_upload.py with args, fail the test unless it succeeds (or fails), return its output """
+
+        process = subprocess.run(self.upload_command(*args), input=stdin, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, env=self.env(), cwd=self.work_dir, timeout=120)
+        output = process.stdout.decode(errors='replace')
+        if succeed:
+            self.assertEqual(process.returncode, 0, output)
+        else:
+            self.assertNotEqual(process.returncode, 0, output)
+        return output
+
+    def start_daemon(self, *args):
+        """ Run gdrive_upload.py --serve with args until the end of the test, return its socket file """
+
+        socket_file = os.path.join(self.work_dir, 'daemon.sock')
+        daemon = subprocess.Popen(self.upload_command('--serve', socket_file, *args), stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL, env=self.env(), cwd=self.work_dir)
+        self.addCleanup(daemon.wait)
+        self.addCleanup(daemon.terminate)
+        deadline = time.monotonic() + 30
+        while not os.path.exists(socket_file):
+            self.assertIsNone(daemon.poll(), "daemon exited")
+            self.assertLess(time.monotonic(), deadline, "daemon did not start")
+            time.sleep(0.05)
+        return socket_file
+
+    def run_submit(self, socket_file: str, *args):
+        process = subprocess.run([sys.executable, SUBMIT_SCRIPT, '--socket', socket_file] + list(args),
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=self.work_dir, timeout=120)
+        output = process.stdout.decode(errors='replace')
+        self.assertEqual(process.returncode, 0, output)
+        return output
+
+    def uploaded(self, title: str):
+        """ Resources of the uploaded (not folder) files titled title """
+
+        return [resource for resource in self.fake.files.values()
+                if resource['title'] == title and 'fileSize' in resource]
+
+    def assert_uploaded(self, title: str, content: bytes):
+        resources = self.uploaded(title)
+        self.assertEqual(len(resources), 1, f"{title} uploaded {len(resources)} times")
+        self.assertEqual(resources[0]['fileSize'], str(len(content)))
+        self.assertEqual(resources[0]['md5Checksum'], hashlib.md5(content).hexdigest())
+
+    def test_upload(self):
+        content = os.urandom(1000)
+        self.run_upload('-f', self.write_file('dir/plain.bin', content))
+        self.assert_uploaded('plain.bin', content)
+
+    def test_chunked_upload(self):
+        content = os.urandom(600 * 1024)
+        self.run_upload('-f', self.write_file('dir/chunked.bin', content), '--chunk-size', '256K')
+        self.assert_uploaded('chunked.bin', content)
+        self.assertEqual(self.fake.stats['upload.chunk'], 3)
+
+    def test_resume(self):
+        content = os.urandom(4 * 256 * 1024)
+        path = self.write_file('dir/resumed.bin', content)
+        upload_chunk = self.fake.upload_chunk
+
+        def fail_third_chunk(session_id, headers, body):
+            if headers.get('content-range', '').startswith(f'bytes {2 * 256 * 1024}-'):
+                return self.fake.json_response({'error': {'code': 503, 'message': 'Backend Error'}}, 503)
+            return upload_chunk(session_id, headers, body)
+
+        self.fake.upload_chunk = fail_third_chunk
+        self.run_upload('-f', path, '--chunk-size', '256K', '--retries', '0', succeed=False)
+        session_dir = os.path.join(self.work_dir, 'cache', 'gdrive_upload', 'sessions')
+        for name in os.listdir(session_dir):
+            # a session URI accepts uploads without credentials
+            self.assertEqual(os.stat(os.path.join(session_dir, name)).st_mode & 0o777, 0o600)
+
+        self.fake.upload_chunk = upload_chunk
+        self.fake.reset_stats()
+        output = self.run_upload('-f', path, '--chunk-size', '256K')
+        self.assertIn(f"Resuming upload from byte {2 * 256 * 1024}", output)
+        self.assertEqual(self.fake.stats['upload.chunk'], 2)
+        self.assert_uploaded('resumed.bin', content)
+        self.assertFalse(os.listdir(session_dir))
+
+    def test_upload_applied_but_failed(self):
+        content = os.urandom(1000)
+        upload_chunk = self.fake.upload_chunk
+        failures = []
+
+        def upload_chunk_applied_but_failed(session_id, headers, body):
+            response = upload_chunk(session_id, headers, body)
+            if response[0] == 200 and not failures:
+                # the file was created, but the client only sees a server error
+                failures.append(session_id)
+                return self.fake.json_response({'error': {'code': 503, 'message': 'Backend Error'}}, 503)
+            return response
+
+        self.fake.upload_chunk = upload_chunk_applied_but_failed
+        self.run_upload('-f', self.write_file('dir/applied.bin', content))
+        self.assertTrue(failures)
+        self.assert_uploaded('applied.bin', content)
+
+    @unittest.skipUnless(importlib.util.find_spec('aiohttp'), "--engine async requires aiohttp")
+    def test_async_upload_applied_but_failed(self):
+        content = os.urandom(1000)
+        media = self.fake.media
+        failures = []
+
+        def multipart_applied_but_failed(method, version, file_id, params, headers, body):
+            response = media(method, version, file_id, params, headers, body)
+            if params.get('uploadType') == 'multipart' and response[0] == 200 and not failures:
+                # the file was created, but the client only sees a server error
+                failures.append(body)
+                return self.fake.json_response({'error': {'code': 503, 'message': 'Backend Error'}}, 503)
+            return response
+
+        self.fake.media = multipart_applied_but_failed
+        self.run_upload('-f', self.write_file('dir/applied.bin', content), '--engine', 'async')
+        self.assertTrue(failures)
+        self.assert_uploaded('applied.bin', content)
+
+    @unittest.skipUnless(importlib.util.find_spec('aiohttp'), "--engine async requires aiohttp")
+    def test_async_upload_failed_beside_identical_file(self):
+        content = os.urandom(1000)
+        self.fake.add_file('identical.bin', size=len(content), md5=hashlib.md5(content).hexdigest())
+        media = self.fake.media
+        failures = []
+
+        def multipart_failed(method, version, file_id, params, headers, body):
+            if params.get('uploadType') == 'multipart' and not failures:
+                failures.append(body)
+                return self.fake.json_response({'error': {'code': 503, 'message': 'Backend Error'}}, 503)
+            return media(method, version, file_id, params, headers, body)
+
+        self.fake.media = multipart_failed
+        self.run_upload('-f', self.write_file('dir/identical.bin', content), '--engine', 'async')
+        self.assertTrue(failures)
+        # the existing copy is not taken for the one the failed request would have created
+        self.assertEqual(len(self.uploaded('identical.bin')), 2)
+
+    def test_stdin(self):
+        content = os.urandom(300 * 1024)
+        self.run_upload('-f', '-', '-n', 'stdin.bin', '--chunk-size', '256K', stdin=content)
+        self.assert_uploaded('stdin.bin', content)
+
+    def test_compress(self):
+        import gzip
+
+        content = b'compressible line\n' * 100000
+        upload_chunk = self.fake.upload_chunk
+        received = []
+
+        def record_chunk(session_id, headers, body):
+            received.append(body)
+            return upload_chunk(session_id, headers, body)
+
+        self.fake.upload_chunk = record_chunk
+        self.run_upload('-f', self.write_file('dir/log.txt', content), '--compress', 'gzip', '--chunk-size', '256K')
+        self.assertFalse(self.uploaded('log.txt'))
+        [resource] = self.uploaded('log.txt.gz')
+        self.assertEqual(resource['mimeType'], 'application/gzip')
+        self.assertLess(int(resource['fileSize']), len(content) // 10)
+        self.assertEqual(gzip.decompress(b''.join(received)), content)
+
+    def test_skip_existing(self):
+        content = os.urandom(1000)
+        path = self.write_file('dir/skip.bin', content)
+        self.run_upload('-f', path, '--skip-existing')
+        self.fake.reset_stats()
+        self.run_upload('-f', path, '--skip-existing')
+        self.assert_uploaded('skip.bin', content)
+        self.assertFalse([name for name in self.fake.stats if name.startswith('upload')], self.fake.stats)
+
+    def test_skip_existing_by_title(self):
+        for index in range(1500):
+            self.fake.add_file(f'other{index}.bin')
+        self.run_upload('-f', self.write_file('dir/single.bin', b'single'), '--skip-existing')
+        # the same-named files only, not the 2 pages of the whole folder
+        self.assertEqual(self.fake.stats['files.list'], 1)
+        self.assert_uploaded('single.bin', b'single')
+
+    def test_recursive(self):
+        content = os.urandom(100)
+        self.write_file('tree/a/b/leaf.bin', content)
+        self.run_upload('-r', os.path.join(self.work_dir, 'tree'))
+        self.assert_uploaded('leaf.bin', content)
+
+    def test_discovery_cached(self):
+        self.run_upload('-f', self.write_file('dir/first.bin', b'first'))
+        self.assertEqual(self.fake.stats['discovery'], 1)
+        self.fake.reset_stats()
+        self.run_upload('-f', self.write_file('dir/second.bin', b'second'))
+        self.assertNotIn('discovery', self.fake.stats)
+        self.assert_uploaded('second.bin', b'second')
+
+    def test_folder_cache(self):
+        folder_id = self.fake.add_folder('cached target')['id']
+        self.run_upload('-f', self.write_file('dir/first.bin', b'first'), '--directory-name', 'cached target')
+        self.fake.reset_stats()
+        output = self.run_upload('-f', self.write_file('dir/second.bin', b'second'),
+                                 '--directory-name', 'cached target')
+        self.assertIn(f"id: {folder_id} (cached)", output)
+        self.assertNotIn('files.list', self.fake.stats)
+        self.assertEqual(self.uploaded('second.bin')[0]['parents'][0]['id'], folder_id)
+
+    def test_folder_cache_deleted_folder(self):
+        folder_id = self.fake.add_folder('moved target')['id']
+        self.run_upload('-f', self.write_file('dir/first.bin', b'first'), '--directory-name', 'moved target')
+        self.fake.dispatch('DELETE', f'/drive/v2/files/{folder_id}', {}, {}, b'')
+        new_folder_id = self.fake.add_folder('moved target')['id']
+        output = self.run_upload('-f', self.write_file('dir/second.bin', b'second'),
+                                 '--directory-name', 'moved target')
+        self.assertIn("Cached folder moved target not found, looking it up again", output)
+        self.assertEqual([resource['parents'][0]['id'] for resource in self.uploaded('second.bin')], [new_folder_id])
+
+    def test_folder_cache_disabled(self):
+        self.fake.add_folder('uncached target')
+        for name in ('first.bin', 'second.bin'):
+            self.fake.reset_stats()
+            output = self.run_upload('-f', self.write_file(f'dir/{name}', b'content'),
+                                     '--directory-name', 'uncached target', '--folder-cache-ttl', '0')
+            self.assertNotIn('(cached)', output)
+            self.assertEqual(self.fake.stats['files.list'], 1)
+
+    def test_connections_kept_per_job(self):
+        for index in range(20):
+            self.write_file(f'many/file{index}.bin', bytes([index]))
+        self.run_upload('-r', os.path.join(self.work_dir, 'many'), '--jobs', '4', '--skip-existing')
+        self.assert_uploaded('file19.bin', bytes([19]))
+        # one connection per worker thread, and a few of the main thread for the folders
+        self.assertLessEqual(self.fake.stats['connections'], 4 + 3)
+
+    def test_recursive_folder_creation_applied_but_failed(self):
+        self.write_file('applied/a/leaf.bin', b'leaf')
+        batch = self.fake.batch
+        failures = []
+
+        def batch_applied_but_failed(headers, body):
+            response = batch(headers, body)
+            if b'POST' in body and not failures:
+                # the folders were created, but the client only sees a server error
+                failures.append(body)
+                return self.fake.json_response({'error': {'code': 503, 'message': 'Backend Error'}}, 503)
+            return response
+
+        self.fake.batch = batch_applied_but_failed
+        self.run_upload('-r', os.path.join(self.work_dir, 'applied'))
+        self.assertTrue(failures)
+        for title in ('applied', 'a'):
+            folders = [resource for resource in self.fake.files.values() if resource['title'] == title]
+            self.assertEqual(len(folders), 1, f"{title} created {len(folders)} times")
+        self.assert_uploaded('leaf.bin', b'leaf')
+
+    def test_sync_folder_creation_applied_but_failed(self):
+        self.write_file('resynced/sub/file.txt', b'first')
+        self.run_upload('--sync', os.path.join(self.work_dir, 'resynced'))
+        # the Drive copy and its folder are gone, the next sync creates the folder when the update fails
+        [folder] = [resource for resource in self.fake.files.values() if resource['title'] == 'sub']
+        [uploaded] = self.uploaded('file.txt')
+        for file_id in (uploaded['id'], folder['id']):
+            self.fake.dispatch('DELETE', f'/drive/v2/files/{file_id}', {}, {}, b'')
+        self.write_file('resynced/sub/file.txt', b'second version')
+        metadata = self.fake.metadata
+        failures = []
+
+        def insert_applied_but_failed(method, version, file_id, params, body):
+            response = metadata(method, version, file_id, params, body)
+            if method == 'POST' and file_id is None and response[0] == 200 and not failures:
+                # the folder was created, but the client only sees a server error
+                failures.append(body)
+                return self.fake.json_response({'error': {'code': 503, 'message': 'Backend Error'}}, 503)
+            return response
+
+        self.fake.metadata = insert_applied_but_failed
+        self.run_upload('--sync', os.path.join(self.work_dir, 'resynced'))
+        self.assertTrue(failures)
+        folders = [resource for resource in self.fake.files.values() if resource['title'] == 'sub']
+        self.assertEqual(len(folders), 1, f"sub created {len(folders)} times")
+        self.assert_uploaded('file.txt', b'second version')
+
+    def test_sync_update_keeps_title(self):
+        path = self.write_file('synced/file.txt', b'first')
+        self.run_upload('--sync', os.path.join(self.work_dir, 'synced'))
+        self.write_file('synced/file.txt', b'second version')
+        self.run_upload('--sync', os.path.join(self.work_dir, 'synced'))
+        self.assert_uploaded(os.path.basename(path), b'second version')
+
+    def test_daemon_runs_jobs_in_parallel(self):
+        contents = {f'job{index}.bin': os.urandom(100) for index in range(4)}
+        paths = [self.write_file(name, content) for name, content in contents.items()]
+        socket_file = self.start_daemon('--jobs', '4')
+        # an upload is a few requests, one after the other
+        self.fake.latency = 0.3
+        start = time.monotonic()
+        self.run_submit(socket_file, '--file', self.write_file('single.bin', b'single'))
+        single_seconds = time.monotonic() - start
+        start = time.monotonic()
+        output = self.run_submit(socket_file, '--file', *paths)
+        self.assertLess(time.monotonic() - start, 2 * single_seconds, "jobs did not run in parallel")
+        for name, content in contents.items():
+            self.assert_uploaded(name, content)
+            self.assertIn(os.path.join(self.work_dir, name), output)
+
+    def test_daemon_skip_existing_by_title(self):
+        for index in range(1500):
+            self.fake.add_file(f'other{index}.bin')
+        path = self.write_file('served.bin', b'served')
+        socket_file = self.start_daemon()
+        self.run_submit(socket_file, '--file', path, '--skip-existing')
+        self.fake.reset_stats()
+        self.run_submit(socket_file, '--file', path, '--skip-existing')
+        self.assert_uploaded('served.bin', b'served')
+        # a single page of same-named files, not every file of the folder
+        self.assertEqual(self.fake.stats['files.list'], 1)
+        self.assertFalse([name for name in self.fake.stats if name.startswith('upload')], self.fake.stats)
+
+    def test_daemon_keeps_other_files(self):
+        output = self.run_upload('--serve', self.credentials, succeed=False)
+        self.assertIn("is not a socket", output)
+        with open(self.credentials) as f:
+            self.assertIn('test-refresh', f.read())
+
+    def test_daemon_socket_private(self):
+        socket_file = self.start_daemon()
+        self.assertEqual(os.stat(socket_file).st_mode & 0o777, 0o600)
+
+    def test_rejects_token_refresh_margin(self):
+        output = self.run_upload('-f', self.write_file('dir/margin.bin', b'margin'), '--token-refresh-margin', '3600',
+                                 succeed=False)
+        self.assertIn("--token-refresh-margin must be between", output)
+
+    def test_daemon_rejects_job_options(self):
+        output = self.run_upload('--serve', os.path.join(self.work_dir, 'daemon.sock'), '--directory-id', 'folder',
+                                 succeed=False)
+        self.assertIn("pass them to gdrive_submit.py", output)
+
+    @unittest.skipUnless(importlib.util.find_spec('aiohttp'), "--engine async requires aiohttp")
+    def test_async_directory_name(self):
+        folder_id = self.fake.add_folder('async target')['id']
+        content = os.urandom(1000)
+        path = self.write_file('dir/async.bin', content)
+        self.run_upload('-f', path, '--engine', 'async', '--directory-name', 'async target')
+        self.assert_uploaded('async.bin', content)
+        self.assertEqual(self.uploaded('async.bin')[0]['parents'][0]['id'], folder_id)
+        # looked up by the engine, then cached
+        self.assertEqual(self.fake.stats['files.list'], 1)
+        self.run_upload('-f', path, '-n', 'async2.bin', '--engine', 'async', '--directory-name', 'async target')
+        self.assertEqual(self.fake.stats['files.list'], 1)
+        self.assertEqual(self.uploaded('async2.bin')[0]['parents'][0]['id'], folder_id)
+
+    def test_stats(self):
+        content = os.urandom(1000)
+        stats_file = os.path.join(self.work_dir, 'stats.jsonl')
+        output = self.run_upload('-f', self.write_file('dir/stats.bin', content), '--stats', '--stats-json',
+                                 stats_file, '--max-bytes-per-second', '10M')
+        self.assertIn('Stats:', output)
+        self.assert_uploaded('stats.bin', content)
+        with open(stats_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record['event'] for record in records], ['upload', 'summary'])
+        self.assertEqual(records[-1]['files'], 1)
+        self.assertEqual(records[-1]['bytes'], len(content))
+
+    def test_metrics_file(self):
+        metrics_file = os.path.join(self.work_dir, 'gdrive_upload.prom')
+        self.run_upload('-f', self.write_file('dir/metrics.bin', os.urandom(1000)), '--metrics-file', metrics_file)
+        with open(metrics_file) as f:
+            metrics = f.read().splitlines()
+        self.assertIn('gdrive_uploads_total 1', metrics)
+        self.assertIn('gdrive_uploaded_bytes_total 1000', metrics)
+
+    def test_daemon_metrics(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        paths = [self.write_file(f'served{index}.bin', os.urandom(1000)) for index in range(3)]
+        socket_file = self.start_daemon('--metrics-port', str(port))
+        self.run_submit(socket_file, '--file', *paths)
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+            metrics = response.read().decode().splitlines()
+        self.assertIn('gdrive_uploads_total 3', metrics)
+        self.assertIn('gdrive_upload_failures_total 0', metrics)
+        self.assertIn('gdrive_uploads_in_flight 0', metrics)
+        # PyDrive streams the body, its size comes from Content-Length
+        sent = [line for line in metrics if line.startswith('gdrive_request_bytes_total{method="upload"}')]
+        self.assertGreater(int(sent[0].split()[1]), 3000)
+
+
+def http_error(status: int, reason='', headers=None):
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    content = {'error': {'code': status, 'message': 'Error'}}
+    if reason:
+        content['error']['errors'] = [{'reason': reason}]
+    return HttpError(httplib2.Response(dict(headers or {}, status=status)), json.dumps(content).encode())
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        from gdrive_retry import RetryPolicy
+
+        self.policy = RetryPolicy(max_attempts=4, base_delay=0.5)
+        sleep = unittest.mock.patch('gdrive_retry.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+        quiet = unittest.mock.patch('gdrive_retry.print', create=True)
+        quiet.start()
+        self.addCleanup(quiet.stop)
+
+    def call(self, *errors):
+        """ policy.call() of a request failing with errors, then returning 'ok'. Returns the calls made """
+
+        calls = []
+
+        def request():
+            calls.append(len(calls))
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return 'ok'
+        self.assertEqual(self.policy.call(request), 'ok')
+        return calls
+
+    def test_retries_server_errors(self):
+        self.assertEqual(len(self.call(http_error(503), http_error(429))), 3)
+        self.assertEqual(self.policy.retries, 2)
+        for (delay,), _ in self.sleep.call_args_list:
+            self.assertLessEqual(delay, 1.0)
+
+    def test_honours_retry_after(self):
+        self.call(http_error(429, headers={'retry-after': '7'}))
+        self.sleep.assert_called_once_with(7.0)
+
+    def test_retries_rate_limit_403(self):
+        self.assertEqual(len(self.call(http_error(403, 'userRateLimitExceeded'), http_error(403, 'rateLimitExceeded'))),
+                         3)
+
+    def test_does_not_retry_forbidden(self):
+        with self.assertRaises(Exception):
+            self.call(http_error(403, 'insufficientFilePermissions'))
+        self.sleep.assert_not_called()
+        self.assertEqual(self.policy.retries, 0)
+
+    def test_gives_up_after_max_attempts(self):
+        with self.assertRaises(Exception):
+            self.call(*[http_error(500)] * 4)
+        self.assertEqual(self.policy.retries, 3)
+
+
+class FakeClock:
+    """ time module stand-in whose sleep() only moves the clock forward """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    time = monotonic
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+        self.slept += seconds
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        clock = unittest.mock.patch('gdrive_ratelimit.time', self.clock)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def test_paces_requests(self):
+        from gdrive_ratelimit import TokenBucket
+
+        bucket = TokenBucket(10)
+        for _ in range(30):
+            bucket.acquire()
+        # the first second worth is a burst, the other 20 requests are spread over 2 seconds
+        self.assertAlmostEqual(self.clock.slept, 2.0)
+
+    def test_debt_beyond_capacity(self):
+        from gdrive_ratelimit import TokenBucket
+
+        bucket = TokenBucket(100)
+        bucket.acquire(500)
+        self.assertAlmostEqual(self.clock.slept, 4.0)
+        # the debt is paid off by the sleep, no more
+        bucket.acquire(100)
+        self.assertAlmostEqual(self.clock.slept, 5.0)
+
+    def test_shared_bucket(self):
+        from gdrive_ratelimit import SharedTokenBucket
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'limits.json')
+            buckets = [SharedTokenBucket(path, 'requests', 10), SharedTokenBucket(path, 'requests', 10)]
+            other = SharedTokenBucket(path, 'bytes', 10)
+            for index in range(30):
+                buckets[index % 2].acquire()
+            other.acquire(10)
+            self.assertAlmostEqual(self.clock.slept, 2.0)
+
+    def test_schedule(self):
+        from gdrive_ratelimit import BandwidthSchedule, TokenBucket, parse_bandwidth_window
+
+        schedule = BandwidthSchedule(100, [parse_bandwidth_window('22:00-06:00=1K'),
+                                           parse_bandwidth_window('12:00-13:00=0')])
+        day = datetime.datetime(2024, 1, 1)
+        rates = [schedule.rate_at(day.replace(hour=hour, minute=minute))
+                 for hour, minute in ((21, 59), (22, 0), (0, 0), (5, 59), (6, 0), (12, 30))]
+        self.assertEqual(rates, [100, 1024, 1024, 1024, 100, 0])
+        with unittest.mock.patch.object(schedule, 'rate_at', return_value=0):
+            bucket = TokenBucket(0, schedule=schedule)
+            bucket.acquire(10 ** 9)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_parse_bandwidth_window(self):
+        from gdrive_ratelimit import parse_bandwidth_window
+
+        self.assertEqual(parse_bandwidth_window('08:00-18:00=1M'), (480, 1080, 1024 * 1024))
+        self.assertEqual(parse_bandwidth_window('18:00-24:00=0'), (1080, 1440, 0))
+        for value in ('24:30-06:00=1M', '08:00-24:30=1M', '24:00-06:00=1M', '08:60-09:00=1M', '08:00=1M'):
+            with self.assertRaises(ValueError, msg=value):
+                parse_bandwidth_window(value)
+
+
+def patch_utcnow(test: unittest.TestCase, module: str):
+    """ Make datetime.datetime.utcnow() of module return test.now until the end of the test """
+
+    class FakeDatetime(datetime.datetime):
+        @classmethod
+        def utcnow(cls):
+            return test.now
+
+    clock = unittest.mock.patch(f'{module}.datetime', unittest.mock.Mock(datetime=FakeDatetime))
+    clock.start()
+    test.addCleanup(clock.stop)
+
+
+class FakeCredentials:
+    """ oauth2client credentials stand-in, refresh() issues a token valid for an hour or fails failures times """
+
+    def __init__(self, test: unittest.TestCase, expires_in: float, failures=0):
+        self.test = test
+        self.access_token = 'token0'
+        self.token_expiry = test.now + datetime.timedelta(seconds=expires_in)
+        self.failures = failures
+        # (time, new token) of every successful refresh
+        self.refreshes = []
+
+    def refresh(self, http):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Token endpoint unavailable")
+        self.access_token = f'token{len(self.refreshes) + 1}'
+        self.token_expiry = self.test.now + datetime.timedelta(hours=1)
+        self.refreshes.append((self.test.now, self.access_token))
+
+    def to_json(self):
+        return json.dumps({'access_token': self.access_token})
+
+
+class TokenManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2024, 1, 1)
+        patch_utcnow(self, 'gdrive_token')
+        quiet = unittest.mock.patch('gdrive_token.print', create=True)
+        quiet.start()
+        self.addCleanup(quiet.stop)
+
+    def run_manager(self, manager, waits: int):
+        """ Run manager until it waited waits times, each wait moving the clock. Returns the waits """
+
+        waited = []
+
+        def wait(seconds):
+            waited.append(seconds)
+            self.now += datetime.timedelta(seconds=seconds)
+            if len(waited) >= waits:
+                manager.stopped.set()
+            return manager.stopped.is_set()
+
+        manager.stopped.wait = wait
+        manager.run()
+        return waited
+
+    def test_refreshes_before_expiry(self):
+        from gdrive_token import TokenManager
+
+        credentials = FakeCredentials(self, expires_in=1000)
+        start = self.now
+        waited = self.run_manager(TokenManager(credentials, margin=300), waits=2)
+        # 300 seconds before the first token expires, then 300 seconds before the refreshed one does
+        self.assertEqual(credentials.refreshes, [(start + datetime.timedelta(seconds=700), 'token1')])
+        self.assertEqual(waited, [700, 3300])
+
+    def test_retries_failed_refresh(self):
+        from gdrive_token import RETRY_INTERVAL, TokenManager
+
+        credentials = FakeCredentials(self, expires_in=100, failures=2)
+        waited = self.run_manager(TokenManager(credentials, margin=300), waits=3)
+        self.assertEqual(waited, [RETRY_INTERVAL, RETRY_INTERVAL, 3300])
+        self.assertEqual([token for _, token in credentials.refreshes], ['token1'])
+
+    def test_refreshes_at_most_every_interval(self):
+        from gdrive_token import MIN_REFRESH_INTERVAL, TokenManager
+
+        # the margin is as long as the whole token lifetime
+        credentials = FakeCredentials(self, expires_in=1000)
+        waited = self.run_manager(TokenManager(credentials, margin=3600), waits=3)
+        self.assertEqual(waited, [MIN_REFRESH_INTERVAL] * 3)
+        self.assertEqual(len(credentials.refreshes), 3)
+
+    def test_saves_refreshed_token(self):
+        from gdrive_token import TokenManager
+
+        with tempfile.TemporaryDirectory() as directory:
+            credentials_file = os.path.join(directory, 'credentials.json')
+            credentials = FakeCredentials(self, expires_in=0)
+            self.run_manager(TokenManager(credentials, credentials_file, margin=300), waits=1)
+            with open(credentials_file) as f:
+                self.assertEqual(json.load(f), {'access_token': 'token1'})
+            self.assertEqual(os.stat(credentials_file).st_mode & 0o777, 0o600)
+            self.assertFalse([name for name in os.listdir(directory) if name.endswith('.tmp')])
+
+
+class ServiceAccountTokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        from gdrive_token import ServiceAccountTokenCache
+
+        self.now = datetime.datetime(2024, 1, 1)
+        patch_utcnow(self, 'gdrive_token')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = os.path.join(directory.name, 'tokens')
+        self.cache = ServiceAccountTokenCache(self.directory, margin=300)
+
+    def credentials(self, key_id='key1', scopes='https://www.googleapis.com/auth/drive', expires_in=None):
+        """ Service account credentials stand-in, with a token valid for expires_in seconds if given """
+
+        return unittest.mock.Mock(
+            _service_account_email='uploader@project.iam.gserviceaccount.com', _private_key_id=key_id,
+            _scopes=scopes, access_token='cached-token' if expires_in is not None else None,
+            token_expiry=self.now + datetime.timedelta(seconds=expires_in) if expires_in is not None else None)
+
+    def test_reuses_valid_token(self):
+        self.cache.save(self.credentials(expires_in=1000))
+        self.now += datetime.timedelta(seconds=600)
+        credentials = self.credentials()
+        self.assertTrue(self.cache.load(credentials))
+        self.assertEqual(credentials.access_token, 'cached-token')
+        self.assertEqual(credentials.token_expiry, datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=1000))
+
+    def test_rejects_token_inside_margin(self):
+        self.cache.save(self.credentials(expires_in=1000))
+        self.now += datetime.timedelta(seconds=701)
+        credentials = self.credentials()
+        self.assertFalse(self.cache.load(credentials))
+        self.assertIsNone(credentials.access_token)
+
+    def test_keyed_by_key_and_scopes(self):
+        self.cache.save(self.credentials(scopes='scope1 scope2', expires_in=1000))
+        self.assertTrue(self.cache.load(self.credentials(scopes='scope2 scope1')))
+        self.assertFalse(self.cache.load(self.credentials(key_id='key2', scopes='scope1 scope2')))
+        self.assertFalse(self.cache.load(self.credentials(scopes='scope1')))
+
+    def test_private_files(self):
+        self.cache.save(self.credentials(expires_in=1000))
+        [name] = os.listdir(self.directory)
+        self.assertEqual(os.stat(os.path.join(self.directory, name)).st_mode & 0o777, 0o600)
+        self.assertEqual(os.stat(self.directory).st_mode & 0o777, 0o700)
+
+
+class DiscoveryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'discovery', 'drive-v2.json')
+        self.http = unittest.mock.Mock()
+
+    def write_cached(self, document: str, age: float):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            f.write(document)
+        modified = time.time() - age
+        os.utime(self.path, (modified, modified))
+
+    def load(self):
+        from gdrive_cache import load_discovery_document
+
+        return load_discovery_document(self.http, self.path, 'http://127.0.0.1:1/discovery', ttl=3600)
+
+    def test_fetches_and_caches(self):
+        self.http.request.return_value = (unittest.mock.Mock(status=200), b'{"fetched": true}')
+        self.assertEqual(self.load(), '{"fetched": true}')
+        self.assertEqual(self.load(), '{"fetched": true}')
+        self.assertEqual(self.http.request.call_count, 1)
+
+    def test_stale_copy_when_fetch_fails(self):
+        self.write_cached('{"stale": true}', age=7200)
+        self.http.request.side_effect = ConnectionError("unreachable")
+        self.assertEqual(self.load(), '{"stale": true}')
+        self.http.request.side_effect = None
+        self.http.request.return_value = (unittest.mock.Mock(status=503), b'')
+        self.assertEqual(self.load(), '{"stale": true}')
+
+    def test_refreshes_stale_copy(self):
+        self.write_cached('{"stale": true}', age=7200)
+        self.http.request.return_value = (unittest.mock.Mock(status=200), b'{"fresh": true}')
+        self.assertEqual(self.load(), '{"fresh": true}')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), '{"fresh": true}')
+
+
+class FakeDriveHttp:
+    """ httplib2.Http stand-in passing requests straight to a FakeDrive, recording (method, body size, clock time) """
+
+    class Response(dict):
+        def __init__(self, status: int, headers: dict):
+            super().__init__((name.lower(), value) for name, value in headers.items())
+            self.status = status
+
+    def __init__(self, fake: FakeDrive, clock: FakeClock):
+        self.fake = fake
+        self.clock = clock
+        self.requests = []
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        uri = urllib.parse.urlsplit(uri)
+        body = body.encode() if isinstance(body, str) else bytes(body or b'')
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        self.requests.append((method, len(body), self.clock.now))
+        params = dict(urllib.parse.parse_qsl(uri.query))
+        status, response_headers, content = self.fake.dispatch(method, uri.path, params, headers, body)
+        return self.Response(status, response_headers), content
+
+
+class BandwidthLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        import functools
+        from gdrive_resumable import SessionStore
+
+        self.clock = FakeClock()
+        self.fake = FakeDrive(seed=0)
+        self.fake.root_url = 'http://fake-drive/'
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for patch in (unittest.mock.patch('gdrive_ratelimit.time', self.clock),
+                      # no sessions in the user's cache, no http objects of other tests
+                      unittest.mock.patch('gdrive_resumable.SessionStore',
+                                          functools.partial(SessionStore, os.path.join(self.directory, 'sessions'))),
+                      unittest.mock.patch('gdrive_upload.thread_local', threading.local()),
+                      unittest.mock.patch('gdrive_upload.print', create=True)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_max_bandwidth(self):
+        from gdrive_resumable import CHUNK_ALIGNMENT, DEFAULT_CHUNK_SIZE
+        from gdrive_upload import UploadOptions, bandwidth_chunk_size, upload
+
+        rate = 2 * CHUNK_ALIGNMENT
+        content = os.urandom(5 * CHUNK_ALIGNMENT + 100)
+        path = os.path.join(self.directory, 'limited.bin')
+        with open(path, 'wb') as f:
+            f.write(content)
+        http = FakeDriveHttp(self.fake, self.clock)
+        drive = unittest.mock.Mock()
+        drive.auth.Get_Http_Object.return_value = http
+
+        resource = upload(drive, path, options=UploadOptions(max_bandwidth=rate))
+        self.assertEqual(resource['md5Checksum'], hashlib.md5(content).hexdigest())
+        chunks = [(size, sent) for method, size, sent in http.requests if method == 'PUT']
+        chunk_size = bandwidth_chunk_size(DEFAULT_CHUNK_SIZE, rate)
+        self.assertEqual(chunk_size, rate)
+        self.assertEqual([size for size, _ in chunks], [chunk_size, chunk_size, CHUNK_ALIGNMENT + 100])
+        # the first second worth goes out at once, every next chunk waits until its bytes fit the rate
+        delays = [sent - chunks[0][1] for _, sent in chunks]
+        for delay, expected in zip(delays, [0, 1.0, 1.0 + (CHUNK_ALIGNMENT + 100) / rate]):
+            self.assertAlmostEqual(delay, expected)
+        self.assertAlmostEqual(self.clock.slept, (len(content) - rate) / rate)
+
+
+class ChunkPipelineTest(unittest.TestCase):
+
+    def test_start(self):
+        from gdrive_resumable import CHUNK_ALIGNMENT, ChunkPipeline
+
+        content = os.urandom(4 * CHUNK_ALIGNMENT)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            with ChunkPipeline(f.name, CHUNK_ALIGNMENT) as pipeline:
+                self.assertEqual(b''.join(bytes(chunk) for _, chunk in pipeline), content)
+            self.assertEqual(pipeline.md5, hashlib.md5(content).hexdigest())
+            # resumed inside the third chunk
+            with ChunkPipeline(f.name, CHUNK_ALIGNMENT, start=2 * CHUNK_ALIGNMENT + 100) as pipeline:
+                chunks = [(offset, bytes(chunk)) for offset, chunk in pipeline]
+            self.assertEqual([offset for offset, _ in chunks], [2 * CHUNK_ALIGNMENT, 3 * CHUNK_ALIGNMENT])
+            self.assertEqual(b''.join(chunk for _, chunk in chunks), content[2 * CHUNK_ALIGNMENT:])
+            self.assertIsNone(pipeline.md5)
+
+    def test_close_stops_threads(self):
+        from gdrive_memory import MemoryBudget
+        from gdrive_resumable import CHUNK_ALIGNMENT, ChunkPipeline
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(os.urandom(3 * CHUNK_ALIGNMENT))
+            f.flush()
+            # a failed upload: the consumer holds the only chunk the budget allows and gives up
+            pipeline = ChunkPipeline(f.name, CHUNK_ALIGNMENT, memory_budget=MemoryBudget(CHUNK_ALIGNMENT))
+            next(iter(pipeline))
+            pipeline.close()
+            for thread in pipeline.threads:
+                thread.join(5)
+            self.assertFalse([thread.name for thread in pipeline.threads if thread.is_alive()])
+
+
+if __name__ == '__main__':
+    unittest.main()